@@ -0,0 +1,491 @@
+#!/bin/python
+# coding: utf-8
+
+# Times inference (the forward pass in eval mode, under torch.no_grad) of the
+# models in models.py on the cpu and, if there is one, on the GPU, so the two
+# can be compared before moving evaluation onto cpu-only machines.
+#
+# Uses random token ids, so no data is needed. For example:
+#    python benchmark.py --model=GRU --batch_size=20 --seq_len=35 --hidden_size=1500 --num_layers=2
+#    python benchmark.py --model=TRANSFORMER --batch_size=128 --seq_len=35 --hidden_size=512 --num_layers=6
+#
+# With --compare_precision it instead compares bf16 autocast against fp32 on
+# the cpu: training-step throughput, and (given --data, and ideally --load)
+# the validation perplexity, e.g.
+#    python benchmark.py --model=GRU --hidden_size=1500 --compare_precision --data=data --load=.../best_params.pt
+#
+# With --check_precision it instead checks that the RNN and GRU run forward and
+# backward under bf16 autocast, with a loss and gradients close to fp32's.
+#
+# With --suite it instead times the forward and backward pass of each of the
+# components (RNN.step and GRU.step over seq_len time-steps, the attention
+# with each backend, LayerNorm) and of each whole model (up to the loss),
+# for every combination of --batch_sizes, --seq_lens, --hidden_sizes,
+# --num_layers_list and --threads, on the cpu. Every case is built from the
+# same seed, warmed up, and timed --iters times; the median, mean, standard
+# deviation and range are reported, and with --json saved (with the torch
+# version, git commit, etc.), so that with --compare the results of two
+# versions of the code can be compared case by case, e.g.
+#    python benchmark.py --suite --json=before.json
+#    (change something)
+#    python benchmark.py --suite --json=after.json --compare=before.json
+# With --forward_only only the forward passes are timed (without gradients),
+# e.g. for the per-step latency of the GRU at inference:
+#    python benchmark.py --suite --forward_only --cases=GRU.step --hidden_sizes=1500 --batch_sizes=1,20
+
+import argparse
+import copy
+import itertools
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import torch
+
+import models
+from models import Batch, LayerNorm, MultiHeadedAttention, run_recurrence, subsequent_mask
+from reader import ptb_raw_data, TensorBatches
+
+
+parser = argparse.ArgumentParser(description='Benchmark inference of the PTB language models')
+parser.add_argument('--model', type=str, default='RNN',
+                    help='type of net (RNN, GRU, TRANSFORMER)')
+parser.add_argument('--seq_len', type=int, default=35)
+parser.add_argument('--batch_size', type=int, default=20)
+parser.add_argument('--hidden_size', type=int, default=200)
+parser.add_argument('--num_layers', type=int, default=2)
+parser.add_argument('--emb_size', type=int, default=200)
+parser.add_argument('--vocab_size', type=int, default=10000)
+parser.add_argument('--num_threads', type=int, default=None,
+                    help='number of cpu threads torch may use (default: torch decides)')
+parser.add_argument('--warmup', type=int, default=3,
+                    help='number of untimed forward passes')
+parser.add_argument('--iters', type=int, default=20,
+                    help='number of timed forward passes')
+parser.add_argument('--attention_backend', type=str, default='reference',
+                    help='attention implementation for TRANSFORMER (reference, sdpa)')
+parser.add_argument('--softmax', type=str, default='full',
+                    help='output layer (full, adaptive, sampled), as in ptb-lm.py')
+parser.add_argument('--adaptive_cutoffs', type=str, default='2000,6000')
+parser.add_argument('--softmax_samples', type=int, default=1024)
+parser.add_argument('--loss_chunk_size', type=int, default=0,
+                    help='compute the loss this many tokens at a time, as in ptb-lm.py')
+parser.add_argument('--jit', type=str, default='eager',
+                    help='eager, script or compile the models (see models.JIT_MODES); \
+                    --suite compares well against an earlier --jit=eager run')
+parser.add_argument('--check_attention', action='store_true',
+                    help='instead of timing, check that the sdpa attention backend \
+                    gives the same outputs and gradients as the reference one')
+parser.add_argument('--check_precision', action='store_true',
+                    help='instead of timing, check that the forward and backward \
+                    passes of the RNN and GRU run under bf16 autocast \
+                    and agree with fp32')
+parser.add_argument('--precision', type=str, default='fp32',
+                    help='fp32, or bf16 for bf16 autocast')
+parser.add_argument('--compare_precision', action='store_true',
+                    help='instead of timing inference, compare bf16 autocast \
+                    against fp32 (training throughput and validation perplexity)')
+parser.add_argument('--data', type=str, default='',
+                    help='data corpus for the perplexities of --compare_precision')
+parser.add_argument('--load', type=str, default='',
+                    help='saved parameters (e.g. best_params.pt) to load into the model')
+parser.add_argument('--suite', action='store_true',
+                    help='instead of timing inference, run the benchmark suite \
+                    (forward and backward of the components and models)')
+parser.add_argument('--cases', type=str,
+                    default='RNN.step,GRU.step,attention:reference,attention:sdpa,LayerNorm,RNN,GRU,TRANSFORMER',
+                    help='comma-separated cases of the suite')
+parser.add_argument('--batch_sizes', type=str, default='20,128')
+parser.add_argument('--seq_lens', type=str, default='35')
+parser.add_argument('--hidden_sizes', type=str, default='256,512',
+                    help='(the attention and TRANSFORMER cases skip sizes that \
+                    are not a multiple of their 16 heads)')
+parser.add_argument('--num_layers_list', type=str, default='2',
+                    help='numbers of layers of the whole models')
+parser.add_argument('--threads', type=str, default='1',
+                    help='numbers of cpu threads')
+parser.add_argument('--forward_only', action='store_true',
+                    help='time only the forward pass of each case, without \
+                    gradients (e.g. the per-step latency of inference)')
+parser.add_argument('--json', type=str, default='',
+                    help='file to save the suite\'s results to')
+parser.add_argument('--compare', type=str, default='',
+                    help='results of an earlier --suite --json run to compare against')
+parser.add_argument('--threshold', type=float, default=0.05,
+                    help='relative change in median time from which --compare \
+                    calls a case faster or slower')
+parser.add_argument('--seed', type=int, default=1111)
+
+
+def build_model(args):
+    """ Builds the model the same way ptb-lm.py does (on the cpu, without dropout). """
+    model = models.build_model(args.model, args.vocab_size, emb_size=args.emb_size,
+                               hidden_size=args.hidden_size, seq_len=args.seq_len,
+                               batch_size=args.batch_size, num_layers=args.num_layers,
+                               attention_backend=args.attention_backend, softmax=args.softmax,
+                               adaptive_cutoffs=[int(c) for c in args.adaptive_cutoffs.split(',')],
+                               softmax_samples=args.softmax_samples)
+    model.loss_chunk_size = args.loss_chunk_size
+    return models.compile_model(model, args.jit)[0]
+
+
+def autocast(args, device, precision=None):
+    precision = precision or args.precision
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16,
+                          enabled=precision == 'bf16')
+
+
+def forward(model, args, inputs, hidden=None):
+    """
+    Runs model on inputs of shape (seq_len, batch_size), as ptb-lm.py does; 
+    returns the logits (or log-probabilities), shape (seq_len, batch_size, 
+    vocab_size), and the final hidden state (None for the Transformer).
+    """
+    if args.model == 'TRANSFORMER':
+        batch = Batch(inputs.t(), pad=-1)
+        return model(batch.data, batch.mask).transpose(0, 1), None
+    if hidden is None:
+        hidden = model.init_hidden()
+    return model(inputs, hidden)
+
+
+def time_inference(model, args, device):
+    """
+    Runs args.warmup untimed and then args.iters timed forward passes on
+    device, and returns the mean time per pass in seconds.
+    """
+    model = model.to(device).eval()
+    inputs = torch.randint(args.vocab_size, (args.seq_len, args.batch_size), device=device)
+    run = lambda: forward(model, args, inputs)
+
+    with torch.no_grad(), autocast(args, device):
+        for _ in range(args.warmup):
+            run()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start_time = time.time()
+        for _ in range(args.iters):
+            run()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+    return (time.time() - start_time) / args.iters
+
+
+def check_attention(args, tolerance=1e-4):
+    """
+    Runs the same Transformer (in eval mode) with the reference and the sdpa 
+    attention, on a causal mask and on a mask with padding (at the end of a 
+    sequence, and at its start), and returns whether the largest differences 
+    in the outputs and in the parameter gradients, each relative to the 
+    largest magnitude in the reference, are within tolerance.
+    """
+    args.model, args.attention_backend = 'TRANSFORMER', 'reference'
+    reference = build_model(args).eval()
+    sdpa = copy.deepcopy(reference)
+    for module in sdpa.modules():
+        if isinstance(module, MultiHeadedAttention):
+            module.backend = 'sdpa'
+
+    inputs = torch.randint(1, args.vocab_size, (args.batch_size, args.seq_len))
+    padded = inputs.clone()
+    padded[0, -3:] = 0  # some trailing padding for the pad=0 mask,
+    padded[-1, 0] = 0   # and padding at position 0, which leaves the first 
+                        # query of that sequence with every key masked
+    worst = 0.
+    for name, x, pad in (('causal', inputs, -1), ('padded', padded, 0)):
+        mask = Batch(x, pad=pad).mask
+        outputs = []
+        for model in (reference, sdpa):
+            model.zero_grad()
+            out = model(x, mask)
+            out.sum().backward()
+            outputs.append((out, [p.grad for p in model.parameters() if p.grad is not None]))
+        (out_ref, grads_ref), (out_sdpa, grads_sdpa) = outputs
+        relative = lambda a, b: ((a - b).abs().max() / a.abs().max().clamp(min=1e-12)).item()
+        diff = relative(out_ref, out_sdpa)
+        # (over all gradients together: some, like the key bias's, are ~0)
+        grad_diff = relative(torch.cat([g.flatten() for g in grads_ref]),
+                             torch.cat([g.flatten() for g in grads_sdpa]))
+        print('  %-6s  output diff %.2e  gradient diff %.2e (relative)' % (name, diff, grad_diff))
+        worst = max(worst, diff, grad_diff)
+        if math.isnan(diff) or math.isnan(grad_diff):  # (e.g. from a fully masked row)
+            worst = float('inf')
+    return worst <= tolerance
+
+
+def check_precision(args, tolerance=1e-1):
+    """
+    Runs the forward pass and the backward pass of the loss of the RNN and the 
+    GRU (in eval mode, on the cpu) in fp32 and under bf16 autocast, and 
+    returns whether both ran, gave finite gradients, and agreed in the loss and in the 
+    parameter gradients to within tolerance (relative, as bf16 keeps ~3 
+    significant digits). Their hidden states stay fp32 under autocast while 
+    the gates are bf16, which the cells must not trip over.
+    """
+    ok = True
+    for args.model in ('RNN', 'GRU'):
+        torch.manual_seed(args.seed)
+        model = build_model(args).eval()
+        x = torch.randint(args.vocab_size, (args.seq_len + 1, args.batch_size))
+        results = []
+        for precision in ('fp32', 'bf16'):
+            model.zero_grad()
+            with autocast(args, torch.device('cpu'), precision):
+                loss = training_loss(model, args.model, x[:-1], x[1:])
+            loss.backward()
+            # (the RNN and GRU also have a self.linear the loss does not use)
+            grads = [p.grad.flatten() for p in model.parameters() if p.grad is not None]
+            results.append((loss.item(), torch.cat(grads)))
+        (loss_32, grads_32), (loss_16, grads_16) = results
+        loss_diff = abs(loss_16 - loss_32) / abs(loss_32)
+        grad_diff = ((grads_16 - grads_32).abs().max() / grads_32.abs().max().clamp(min=1e-12)).item()
+        print('  %-11s loss diff %.2e  gradient diff %.2e (relative)' % (args.model, loss_diff, grad_diff))
+        ok = ok and bool(torch.isfinite(grads_16).all()) and max(loss_diff, grad_diff) <= tolerance
+    return ok
+
+
+def training_loss(model, model_name, inputs, targets):
+    """ The mean loss of model on inputs, shape (seq_len, batch_size), computed as in ptb-lm.py. """
+    if model_name == 'TRANSFORMER':
+        batch = Batch(inputs.t(), pad=-1)
+        features = model.features(batch.data, batch.mask).transpose(0, 1)
+    else:
+        features, _ = model.features(inputs, model.init_hidden())
+    return model.output_loss(features.reshape(-1, features.size(-1)), targets.reshape(-1)).float().mean()
+
+
+def time_training(model, args, precision):
+    """
+    Mean time in seconds of a training step (forward, loss, backward, SGD 
+    update) on the cpu, with the loss computed as in ptb-lm.py.
+    """
+    model = copy.deepcopy(model).train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, foreach=True)
+    device = torch.device('cpu')
+    x = torch.randint(args.vocab_size, (args.seq_len + 1, args.batch_size))
+    inputs, targets = x[:-1], x[1:]
+    def step():
+        model.zero_grad()
+        with autocast(args, device, precision):
+            loss = training_loss(model, args.model, inputs, targets)
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(args.warmup):
+        step()
+    start_time = time.time()
+    for _ in range(args.iters):
+        step()
+    return (time.time() - start_time) / args.iters
+
+
+def perplexity(model, args, batches, precision):
+    """ Perplexity of model (in eval mode, on the cpu) on batches, as in ptb-lm.py's validation. """
+    model.eval()
+    hidden = None
+    total = 0.
+    with torch.no_grad(), autocast(args, torch.device('cpu'), precision):
+        for inputs, targets in batches:
+            outputs, hidden = forward(model, args, inputs, hidden)
+            total += torch.nn.functional.cross_entropy(
+                outputs.float().reshape(-1, args.vocab_size), targets.reshape(-1)).item()
+    return math.exp(total / len(batches))
+
+
+def compare_precision(args):
+    """ Prints training throughput, and validation perplexity if there is --data, for fp32 and bf16. """
+    valid_batches = None
+    if args.data:
+        _, valid_data, _, word_to_id, _ = ptb_raw_data(data_path=args.data)
+        args.vocab_size = len(word_to_id)
+        valid_batches = TensorBatches(valid_data, args.batch_size, args.seq_len)
+    model = build_model(args)
+    if args.load:
+        model.load_state_dict(torch.load(args.load, map_location='cpu'))
+
+    results = {}
+    for precision in ('fp32', 'bf16'):
+        seconds = time_training(model, args, precision)
+        ppl = perplexity(model, args, valid_batches, precision) if valid_batches else float('nan')
+        results[precision] = (args.seq_len * args.batch_size / seconds, ppl)
+        print('  %-4s  train %10.0f wps   val ppl %10.2f' % ((precision,) + results[precision]))
+    (wps_32, ppl_32), (wps_16, ppl_16) = results['fp32'], results['bf16']
+    print('  bf16 vs fp32: %.2fx throughput, %+.2f val ppl' % (wps_16 / wps_32, ppl_16 - ppl_32))
+
+
+def suite_case(case, batch_size, seq_len, hidden_size, num_layers, args):
+    """
+    Builds a case of the suite (on the cpu, from args.seed) and returns a 
+    function running its forward pass once and returning its output (to 
+    backpropagate from the sum of), or None if the case does not apply to 
+    these sizes.
+    """
+    torch.manual_seed(args.seed)
+    if case in ('RNN.step', 'GRU.step'):
+        # one layer's time loop, from precomputed input projections
+        name = case.split('.')[0]
+        model = models.build_model(name, args.vocab_size, emb_size=hidden_size, hidden_size=hidden_size,
+                                   num_layers=1, batch_size=batch_size)
+        model = models.compile_model(model, args.jit)[0]
+        if name == 'RNN':
+            step, width = lambda xp, h: model.step(xp, h, model.Wh[0]), hidden_size
+        else:
+            step, width = lambda xp, h: model.step(xp, h, 0), 3 * hidden_size
+        xp = torch.randn(seq_len, batch_size, width, requires_grad=True)
+        h0 = torch.zeros(batch_size, hidden_size)
+        return lambda: run_recurrence(step, xp, h0)[0]
+    if case.startswith('attention:'):
+        if hidden_size % 16:
+            return None
+        attention = MultiHeadedAttention(16, hidden_size, backend=case.split(':')[1])
+        x = torch.randn(batch_size, seq_len, hidden_size, requires_grad=True)
+        mask = subsequent_mask(seq_len)
+        return lambda: attention(x, x, x, mask)
+    if case == 'LayerNorm':
+        norm = LayerNorm(hidden_size)
+        if args.jit == 'script':
+            norm = torch.jit.script(norm)
+        elif args.jit == 'compile':
+            norm.compile()
+        x = torch.randn(batch_size, seq_len, hidden_size, requires_grad=True)
+        return lambda: norm(x)
+    if case in ('RNN', 'GRU', 'TRANSFORMER'):
+        if case == 'TRANSFORMER' and hidden_size % 16:
+            return None
+        model = models.build_model(case, args.vocab_size, emb_size=hidden_size, hidden_size=hidden_size,
+                                   seq_len=seq_len, batch_size=batch_size, num_layers=num_layers,
+                                   attention_backend=args.attention_backend, softmax=args.softmax)
+        model.loss_chunk_size = args.loss_chunk_size
+        model = models.compile_model(model, args.jit)[0]
+        x = torch.randint(args.vocab_size, (seq_len + 1, batch_size))
+        return lambda: training_loss(model, case, x[:-1], x[1:])
+    raise ValueError('unknown case %s' % case)
+
+
+def suite_metadata():
+    """ What the results depend on besides the code: the versions and the machine. """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'git_commit': commit, 'torch': torch.__version__, 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def run_suite(args):
+    """ Times every case of the suite; returns the results, one dict per case. """
+    parse = lambda values: [int(v) for v in values.split(',')]
+    results = []
+    print('%-20s %5s %5s %5s %3s %3s %10s %10s %8s %12s' % (
+        'case', 'batch', 'seq', 'hid', 'L', 'thr', 'median ms', 'mean ms', 'std %', 'tokens/s'))
+    for case, batch_size, seq_len, hidden_size, num_layers, threads in itertools.product(
+            args.cases.split(','), parse(args.batch_sizes), parse(args.seq_lens),
+            parse(args.hidden_sizes), parse(args.num_layers_list), parse(args.threads)):
+        if case not in ('RNN', 'GRU', 'TRANSFORMER'):
+            # only the whole models have layers; the components run once, as 1
+            if num_layers != parse(args.num_layers_list)[0]:
+                continue
+            num_layers = 1
+        torch.set_num_threads(threads)
+        forward = suite_case(case, batch_size, seq_len, hidden_size, num_layers, args)
+        if forward is None:
+            continue
+        if args.forward_only:
+            def run():
+                with torch.no_grad():
+                    forward()
+        else:
+            run = lambda: forward().sum().backward()
+        for _ in range(args.warmup):
+            run()
+        times = []
+        for _ in range(args.iters):
+            start_time = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start_time)
+        median = statistics.median(times)
+        std = statistics.stdev(times) if len(times) > 1 else 0.
+        result = dict(case=case, batch_size=batch_size, seq_len=seq_len, hidden_size=hidden_size,
+                      num_layers=num_layers, threads=threads, forward_only=args.forward_only, iters=len(times),
+                      median_ms=1000 * median, mean_ms=1000 * statistics.mean(times),
+                      std_ms=1000 * std, min_ms=1000 * min(times), max_ms=1000 * max(times),
+                      tokens_per_s=batch_size * seq_len / median)
+        results.append(result)
+        print('%-20s %5d %5d %5d %3d %3d %10.3f %10.3f %8.1f %12.0f' % (
+            case, batch_size, seq_len, hidden_size, num_layers, threads, result['median_ms'],
+            result['mean_ms'], 100 * result['std_ms'] / result['mean_ms'], result['tokens_per_s']))
+    return results
+
+
+def compare_suite(results, baseline, threshold):
+    """ Prints, for the cases in both, the speedup of results over baseline (from its median times). """
+    key = lambda r: (r['case'], r['batch_size'], r['seq_len'], r['hidden_size'], r['num_layers'],
+                     r['threads'], r.get('forward_only', False))
+    before = dict((key(r), r) for r in baseline['results'])
+    print('\ncompared with %s (commit %s):' % (baseline['meta']['time'], baseline['meta']['git_commit']))
+    for r in results:
+        if key(r) not in before:
+            continue
+        speedup = before[key(r)]['median_ms'] / r['median_ms']
+        verdict = 'faster' if speedup > 1 + threshold else 'SLOWER' if speedup < 1 - threshold else ''
+        print('%-20s %5d %5d %5d %3d %3d %10.3f -> %10.3f ms  %5.2fx %s' % (
+            key(r)[:6] + (before[key(r)]['median_ms'], r['median_ms'], speedup, verdict)))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(args.seed)
+
+    if args.suite:
+        meta = suite_metadata()
+        print('Benchmark suite, torch %s, commit %s, %s cpus' % (meta['torch'], meta['git_commit'], meta['cpu_count']))
+        results = run_suite(args)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'meta': meta, 'args': vars(args), 'results': results}, f, indent=1)
+        if args.compare:
+            with open(args.compare) as f:
+                compare_suite(results, json.load(f), args.threshold)
+        sys.exit(0)
+
+    if args.compare_precision:
+        print('%s, bf16 autocast against fp32 on the cpu' % args.model)
+        compare_precision(args)
+        sys.exit(0)
+
+    if args.check_attention:
+        print('Checking sdpa against reference attention')
+        ok = check_attention(args)
+        print('  OK' if ok else '  MISMATCH')
+        sys.exit(0 if ok else 1)
+
+    if args.check_precision:
+        print('Checking bf16 autocast against fp32')
+        ok = check_precision(args)
+        print('  OK' if ok else '  MISMATCH')
+        sys.exit(0 if ok else 1)
+
+    devices = [torch.device('cpu')]
+    if torch.cuda.is_available():
+        devices.append(torch.device('cuda'))
+
+    model = build_model(args)
+    print('%s inference, batch_size=%d seq_len=%d hidden_size=%d num_layers=%d, %d cpu threads' % (
+        args.model, args.batch_size, args.seq_len, args.hidden_size, args.num_layers,
+        torch.get_num_threads()))
+    results = {}
+    for device in devices:
+        results[device.type] = time_inference(model, args, device)
+        print('  %-5s %8.2f ms/batch  %10.0f wps' % (
+            device.type, 1000 * results[device.type],
+            args.seq_len * args.batch_size / results[device.type]))
+    if 'cuda' in results:
+        print('  cpu is %.1fx slower than cuda' % (results['cpu'] / results['cuda']))
@@ -0,0 +1,106 @@
+#!/bin/python
+# coding: utf-8
+
+# Samples from a (saved) RNN, GRU or Transformer language model, and measures
+# sampling throughput, in tokens per second, for each of a list of batch sizes.
+#
+# The model flags must match the ones the model was trained with. For example:
+#    python generate.py --model=GRU --hidden_size=1500 --num_layers=2 \
+#        --load=GRU_SGD_LR_SCHEDULE_..._0/best_params.pt --generated_seq_len=35 --top_k=50
+#
+# Without --load the model is randomly initialized (useful for timing only).
+
+import argparse
+import time
+import torch
+
+import models
+from reader import ptb_raw_data
+
+
+parser = argparse.ArgumentParser(description='Sample from the PTB language models')
+parser.add_argument('--data', type=str, default='data',
+                    help='location of the data corpus (for the vocabulary and the \
+                    seed words); an empty string means random seeds and no vocabulary')
+parser.add_argument('--model', type=str, default='RNN',
+                    help='type of net (RNN, GRU, TRANSFORMER)')
+parser.add_argument('--load', type=str, default='',
+                    help='saved parameters (e.g. best_params.pt) to sample from')
+parser.add_argument('--hidden_size', type=int, default=200)
+parser.add_argument('--num_layers', type=int, default=2)
+parser.add_argument('--emb_size', type=int, default=200)
+parser.add_argument('--softmax', type=str, default='full',
+                    help='output layer the model was trained with (full, adaptive, sampled)')
+parser.add_argument('--adaptive_cutoffs', type=str, default='2000,6000')
+parser.add_argument('--vocab_size', type=int, default=10000,
+                    help='only used when there is no --data')
+parser.add_argument('--generated_seq_len', type=int, default=35)
+parser.add_argument('--batch_sizes', type=str, default='1,8,64',
+                    help='comma-separated batch sizes to sample (and time) with')
+parser.add_argument('--temperature', type=float, default=1.,
+                    help='softmax temperature; 0 means greedy decoding')
+parser.add_argument('--top_k', type=int, default=0,
+                    help='if > 0, sample only among the top_k most likely words')
+parser.add_argument('--top_p', type=float, default=1.,
+                    help='if < 1, sample only among the most likely words making \
+                    up top_p of the probability (nucleus sampling)')
+parser.add_argument('--stop_at_eos', action='store_true',
+                    help='stop each sequence at <eos>, and sampling once all have')
+parser.add_argument('--num_shown', type=int, default=3,
+                    help='number of samples to print for each batch size')
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--seed', type=int, default=1111)
+
+
+def sample(model, seeds, args, eos=None):
+    """ Samples args.generated_seq_len tokens after each seed token; returns (samples, seconds). """
+    if args.model == 'TRANSFORMER':
+        run = lambda: model.generate(seeds, args.generated_seq_len, args.temperature,
+                                     args.top_k, args.top_p, eos)
+    else:
+        model.batch_size = seeds.size(0)
+        hidden = model.init_hidden()
+        run = lambda: model.generate(seeds, hidden, args.generated_seq_len, args.temperature,
+                                     args.top_k, args.top_p, eos)
+    if seeds.is_cuda:
+        torch.cuda.synchronize(seeds.device)
+    start_time = time.time()
+    samples = run()
+    if seeds.is_cuda:
+        torch.cuda.synchronize(seeds.device)
+    return samples, time.time() - start_time
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+
+    id_2_word, eos, seed_words = None, None, None
+    if args.data:
+        train_data, valid_data, _, word_to_id, id_2_word = ptb_raw_data(data_path=args.data)
+        args.vocab_size = len(word_to_id)
+        eos = word_to_id['<eos>'] if args.stop_at_eos else None
+        seed_words = torch.from_numpy(valid_data.astype('int64'))
+
+    model = models.build_model(args.model, args.vocab_size, emb_size=args.emb_size,
+                               hidden_size=args.hidden_size, num_layers=args.num_layers,
+                               softmax=args.softmax,
+                               adaptive_cutoffs=[int(c) for c in args.adaptive_cutoffs.split(',')])
+    if args.load:
+        model.load_state_dict(torch.load(args.load, map_location='cpu'))
+    model = model.to(device).eval()
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        if seed_words is not None:
+            seeds = seed_words[torch.randint(len(seed_words), (batch_size,))].to(device)
+        else:
+            seeds = torch.randint(args.vocab_size, (batch_size,), device=device)
+        sample(model, seeds, args, eos)  # warmup
+        samples, seconds = sample(model, seeds, args, eos)
+        print('batch_size %4d: %10.0f tokens/s  (%d x %d tokens in %.3f s)' % (
+            batch_size, samples.numel() / seconds, samples.size(0), batch_size, seconds))
+        if id_2_word is not None:
+            for i in range(min(args.num_shown, batch_size)):
+                words = [id_2_word[int(w)] for w in [seeds[i]] + list(samples[:, i])]
+                print('    ' + ' '.join(words))
@@ -3,8 +3,8 @@ import torch.nn as nn
 
 import numpy as np
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import math, copy, time
-from torch.autograd import Variable
 import matplotlib.pyplot as plt
 
 # NOTE ==============================================
@@ -42,9 +42,271 @@ def clones(module, N):
     """
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
 
+
+def run_recurrence(step, inputs, h0, checkpoint_steps=0):
+    """
+    A helper for running one recurrent layer over all time-steps, given the 
+    input projections for every time-step (computed up front in one matmul).
+
+    inputs:
+        step: a function mapping (input projection at t, hidden state at t-1)
+              to the hidden state at t
+        inputs: the input projections, shape (seq_len, batch_size, *)
+        h0: the initial hidden state, shape (batch_size, hidden_size)
+        checkpoint_steps: if > 0 (and gradients are needed), the time-steps 
+              are run in chunks of this many, with activation checkpointing: 
+              only the hidden states are kept for the backward pass, and the 
+              rest of each chunk (e.g. the GRU's gates) is recomputed then.
+
+    returns:
+        the hidden states at every time-step, shape (seq_len, batch_size, hidden_size),
+        and the final hidden state, shape (batch_size, hidden_size)
+    """
+    if checkpoint_steps > 0 and torch.is_grad_enabled():
+        chunks = []
+        h = h0
+        for chunk in inputs.split(checkpoint_steps):
+            states = torch.utils.checkpoint.checkpoint(
+                run_recurrence, step, chunk, h, use_reentrant=False)[0]
+            h = states[-1]
+            chunks.append(states)
+        return torch.cat(chunks), h
+    # unbind (rather than indexing inputs[t]) keeps the backward pass linear in 
+    # seq_len: each indexed slice would scatter its gradient into a fresh 
+    # zero-filled tensor the size of inputs.
+    inputs = inputs.unbind(0)
+    h = h0
+    if torch.is_grad_enabled():
+        # Writing into a preallocated buffer in-place makes autograd clone the 
+        # whole buffer once per time-step on the backward pass, so when 
+        # gradients are needed we collect the states and copy them out once.
+        states = []
+        for x_t in inputs:
+            h = step(x_t, h)
+            states.append(h)
+        return torch.stack(states), h
+    states = h0.new_empty(len(inputs), *h0.size())
+    for t, x_t in enumerate(inputs):
+        h = step(x_t, h)
+        states[t] = h
+    return states, h
+
+def sample_next(logits, temperature=1., top_k=0, top_p=1.):
+    """
+    Samples one token per row of logits (or log-probabilities).
+
+    inputs:
+        logits: shape (batch_size, vocab_size)
+        temperature: the logits are divided by this; 0 means greedy (argmax)
+        top_k: if > 0, only sample among the top_k most likely tokens
+        top_p: if < 1, only sample among the most likely tokens whose 
+               probabilities add up to at least top_p (nucleus sampling)
+
+    returns:
+        the sampled token ids, shape (batch_size)
+    """
+    if temperature == 0:
+        return logits.argmax(-1)
+    logits = logits / temperature
+    if top_k > 0:
+        kth_best = logits.topk(min(top_k, logits.size(-1)), dim=-1)[0][:, -1:]
+        logits = logits.masked_fill(logits < kth_best, -float('inf'))
+    if top_p < 1:
+        sorted_logits, order = logits.sort(-1, descending=True)
+        probs = F.softmax(sorted_logits, -1)
+        # drop a token if the ones before it already reach top_p
+        drop = probs.cumsum(-1) - probs >= top_p
+        logits = logits.scatter(-1, order, sorted_logits.masked_fill(drop, -float('inf')))
+    return torch.multinomial(F.softmax(logits, -1), 1).squeeze(1)
+
+
+def sample_sequences(next_logits, input, generated_seq_len, temperature=1., top_k=0, top_p=1., eos=None):
+    """
+    The sampling loop shared by the models' generate methods.
+
+    inputs:
+        next_logits: a function mapping the current tokens, shape (batch_size) 
+                     (or the seed, for the first call), to the logits for the 
+                     next token, shape (batch_size, vocab_size); it carries the 
+                     model's state (hidden state, key/value cache) between calls
+        input: the seed tokens
+        generated_seq_len: the number of tokens to sample
+        temperature, top_k, top_p: see sample_next
+        eos: if given, sequences that have sampled this token are padded with 
+             it from then on, and sampling stops once they all have
+
+    returns:
+        the sampled tokens, shape (generated_seq_len, batch_size), or fewer 
+        rows if every sequence reached eos early
+    """
+    batch_size = input.size(0)
+    samples = input.new_empty(generated_seq_len, batch_size)
+    finished = input.new_zeros(batch_size, dtype=torch.bool)
+    tokens = input
+    for t in range(generated_seq_len):
+        tokens = sample_next(next_logits(tokens), temperature, top_k, top_p)
+        if eos is not None:
+            tokens = tokens.masked_fill(finished, eos)
+            finished |= tokens == eos
+        samples[t] = tokens
+        if eos is not None and bool(finished.all()):
+            return samples[:t + 1]
+    return samples
+
+
+# The output layer ("softmax") of the models can be:
+#   full:     logits over the whole vocabulary (the default)
+#   adaptive: an adaptive softmax (Grave et al., 2017), where the most frequent 
+#             words are scored directly and the rarer ones in tail clusters
+#   sampled:  the full softmax, but trained with a sampled softmax loss 
+#             (evaluation, and the outputs of forward, stay exact)
+SOFTMAXES = ('full', 'adaptive', 'sampled')
+
+def adaptive_softmax(n_units, vocab_size, cutoffs):
+    """
+    An nn.AdaptiveLogSoftmaxWithLoss over vocab_size words, clustered at 
+    cutoffs (the ones inside the vocabulary). This relies on the word ids 
+    being in order of decreasing frequency, which is how reader._build_vocab 
+    numbers them.
+    """
+    cutoffs = sorted(c for c in cutoffs if 0 < c < vocab_size)
+    if not cutoffs:
+        raise ValueError("no adaptive softmax cutoff is inside the vocabulary (size %d)" % vocab_size)
+    return nn.AdaptiveLogSoftmaxWithLoss(n_units, vocab_size, cutoffs, div_value=4.)
+
+def adaptive_output(adaptive, x, targets=None):
+    """
+    The log-probabilities of every word given features x, shape (n, n_units), 
+    or, given targets, the losses of the targets, shape (n). Computed in fp32 
+    (also under autocast, which AdaptiveLogSoftmaxWithLoss does not support).
+    """
+    with torch.autocast(x.device.type, enabled=False):
+        if targets is None:
+            return adaptive.log_prob(x.float())
+        return -adaptive(x.float(), targets).output
+
+def sampled_softmax_loss(x, targets, weight, bias, n_samples):
+    """
+    The sampled softmax loss (Jean et al., 2015) of every token: the softmax 
+    is over the target and n_samples words drawn (shared by all the tokens) 
+    from a log-uniform distribution, which approximates the word frequencies 
+    when the ids are in order of frequency, instead of over the whole vocabulary.
+
+    inputs:
+        x: the features, shape (n_tokens, n_units)
+        targets: the target ids, shape (n_tokens)
+        weight, bias: the output layer, shapes (vocab_size, n_units) and (vocab_size)
+        n_samples: the number of sampled words
+
+    returns:
+        the loss of every token, shape (n_tokens)
+    """
+    vocab_size = weight.size(0)
+    log_range = math.log(vocab_size + 1)
+    def log_expected_count(ids):
+        ids = ids.float()
+        return math.log(n_samples) + torch.log(torch.log1p(1 / (ids + 1)) / log_range)
+
+    u = torch.rand(n_samples, device=x.device)
+    samples = (torch.exp(u * log_range).long() - 1).clamp(0, vocab_size - 1)
+    # The logits are corrected by the log of how often each word is expected 
+    # to be drawn, so that the loss is (nearly) unbiased.
+    true_logits = (x * weight[targets]).sum(-1) + bias[targets] - log_expected_count(targets)
+    sampled_logits = torch.addmm(bias[samples], x, weight[samples].t()) - log_expected_count(samples)
+    # a sample that happens to be the target is not a negative for it
+    sampled_logits = sampled_logits.masked_fill(samples == targets.unsqueeze(1), -float('inf'))
+    logits = torch.cat([true_logits.unsqueeze(1), sampled_logits], 1).float()
+    return -F.log_softmax(logits, -1)[:, 0]
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    The cross-entropy losses of the targets under the output layer (weight, 
+    bias), shapes (vocab_size, n_units) and (vocab_size), applied to the 
+    features x, shape (n, n_units), computed chunk_size rows at a time: at 
+    most chunk_size rows of logits exist at once, and only the log-sum-exp 
+    of each row is kept for the backward pass, which recomputes each 
+    chunk's logits (one more output matmul) rather than storing them all.
+    """
+    @staticmethod
+    def forward(ctx, x, targets, weight, bias, chunk_size):
+        # the backward pass recomputes the logits the same way (autocast or not)
+        device_type = x.device.type
+        ctx.autocast = (device_type, torch.get_autocast_dtype(device_type),
+                        torch.is_autocast_enabled(device_type))
+        ctx.chunk_size = chunk_size
+        lse = x.new_empty(x.size(0), dtype=torch.float)
+        losses = x.new_empty(x.size(0), dtype=torch.float)
+        for start in range(0, x.size(0), chunk_size):
+            rows = slice(start, start + chunk_size)
+            logits = F.linear(x[rows], weight, bias).float()
+            lse[rows] = torch.logsumexp(logits, -1)
+            losses[rows] = lse[rows] - logits.gather(1, targets[rows].unsqueeze(1)).squeeze(1)
+        ctx.save_for_backward(x, targets, weight, bias, lse)
+        return losses
+
+    @staticmethod
+    def backward(ctx, grad_losses):
+        x, targets, weight, bias, lse = ctx.saved_tensors
+        device_type, dtype, enabled = ctx.autocast
+        grad_x = torch.empty_like(x)
+        grad_weight = torch.zeros_like(weight, dtype=torch.float)
+        grad_bias = torch.zeros_like(bias, dtype=torch.float)
+        for start in range(0, x.size(0), ctx.chunk_size):
+            rows = slice(start, start + ctx.chunk_size)
+            with torch.autocast(device_type, dtype, enabled=enabled):
+                logits = F.linear(x[rows], weight, bias).float()
+            # d loss / d logits = softmax - one_hot(target)
+            grad_logits = torch.exp(logits.sub_(lse[rows].unsqueeze(1)))
+            grad_logits[torch.arange(grad_logits.size(0), device=x.device), targets[rows]] -= 1
+            grad_logits.mul_(grad_losses[rows].float().unsqueeze(1))
+            grad_x[rows] = grad_logits.mm(weight.float())
+            grad_weight.addmm_(grad_logits.t(), x[rows].float())
+            grad_bias.add_(grad_logits.sum(0))
+        return grad_x, None, grad_weight.to(weight.dtype), grad_bias.to(bias.dtype), None
+
+def chunked_cross_entropy(x, targets, weight, bias, chunk_size):
+    "See ChunkedCrossEntropy; the same losses as F.cross_entropy(F.linear(x, weight, bias), targets, reduction='none')."
+    return ChunkedCrossEntropy.apply(x, targets, weight, bias, chunk_size)
+
+
+# The recurrent cells, as functions of tensors only (no modules or Python 
+# state), so that compile_model can script or compile them; eagerly they 
+# are the same ops as always.
+def rnn_cell(xp, h, Wh):
+    "One time-step of a vanilla RNN layer; xp is the precomputed x @ Wx + bh."
+    return torch.tanh(torch.addmm(xp, h, Wh))
+
+def gru_cell(xp, h, Urz, Uh):
+    """
+    One time-step of a GRU layer; xp holds the precomputed input projections 
+    of the reset gate, update gate and candidate, concatenated along dim 1, 
+    and Urz the recurrent weights of both gates, so the step is two matmuls: 
+    one for the gates, and (after the reset) one for the candidate.
+    """
+    xrz, xh = xp.split(2 * h.size(1), 1)
+    r, z = torch.sigmoid(torch.addmm(xrz, h, Urz)).chunk(2, 1)
+    h_ = torch.tanh(torch.addmm(xh, r * h, Uh))
+    # (1 - z) * h + z * h_; not torch.lerp, which needs h (fp32 under bf16 
+    # autocast) and h_, z (bf16) to have the same dtype
+    return h + z * (h_ - h)
+
+# The same, with the recurrent matmuls done by modules (the model's linears, 
+# int8 quantized, see quantize_model) instead of with the weight matrices.
+def linear_rnn_cell(xp, h, Wh):
+    return torch.tanh(xp + Wh(h))
+
+def linear_gru_cell(xp, h, Urz, Uh):
+    xrz, xh = xp.split(2 * h.size(1), 1)
+    r, z = torch.sigmoid(xrz + Urz(h)).chunk(2, 1)
+    h_ = torch.tanh(xh + Uh(r * h))
+    return h + z * (h_ - h)
+
+
 # Problem 1
 class RNN(nn.Module): # Implement a stacked vanilla RNN with Tanh nonlinearities.
-  def __init__(self, emb_size, hidden_size, seq_len, batch_size, vocab_size, num_layers, dp_keep_prob):
+  def __init__(self, emb_size, hidden_size, seq_len, batch_size, vocab_size, num_layers, dp_keep_prob,
+               softmax='full', adaptive_cutoffs=(2000, 6000), softmax_samples=1024):
     """
     emb_size:     The number of units in the input embeddings
     hidden_size:  The number of hidden units per layer
@@ -55,6 +317,9 @@ class RNN(nn.Module): # Implement a stacked vanilla RNN with Tanh nonlinearities
     dp_keep_prob: The probability of *not* dropping out units in the 
                   non-recurrent connections.
                   Do not apply dropout on recurrent connections.
+    softmax:      The output layer: 'full', 'adaptive' or 'sampled' (see 
+                  SOFTMAXES); adaptive_cutoffs are the adaptive softmax's 
+                  clusters, and softmax_samples the number of sampled words.
     """
     super(RNN, self).__init__()
 
@@ -80,16 +345,26 @@ class RNN(nn.Module): # Implement a stacked vanilla RNN with Tanh nonlinearities
     self.vocab_size = vocab_size
     self.num_layers = num_layers
     self.dp_keep_prob = dp_keep_prob
+    assert softmax in SOFTMAXES
+    self.output_softmax = softmax
+    self.adaptive_cutoffs = adaptive_cutoffs
+    self.softmax_samples = softmax_samples
+    # if > 0, the time loop is checkpointed in chunks of this many time-steps 
+    # (see run_recurrence), trading recomputation for memory when training
+    self.checkpoint_steps = 0
+    # if > 0, the full softmax's loss is computed this many rows at a time 
+    # (see ChunkedCrossEntropy), never holding the logits of every token
+    self.loss_chunk_size = 0
+    # the time-step function, replaced by a scripted or compiled one by compile_model
+    self.cell = rnn_cell
+    # the weight matrices as (quantized) linear modules, set by quantize_model
+    self.linears = None
     
     self.wb = WordEmbedding(emb_size, vocab_size)
     self.dropout = nn.Dropout(1 - dp_keep_prob)
     self.linear = nn.Linear(hidden_size, vocab_size)
     
     self.tanh = torch.nn.Tanh()
-    if torch.cuda.is_available():
-        self.device = torch.device("cuda") 
-    else:
-        self.device = torch.device("cpu")
 
     self.init_weights()
     
@@ -100,13 +375,26 @@ class RNN(nn.Module): # Implement a stacked vanilla RNN with Tanh nonlinearities
     # Initialize all other (i.e. recurrent and linear) weights AND biases uniformly 
     # in the range [-k, k] where k is the square root of 1/hidden_size
     k = math.sqrt(1/self.hidden_size)
+    # The first layer reads the embeddings, the others the layer below.
+    in_sizes = [self.emb_size] + [self.hidden_size] * (self.num_layers - 1)
+    # Registered as parameters (created on the CPU), so they are trained and 
+    # saved with the model and follow model.to(device).
+    def uniform(*size):
+        return nn.Parameter(torch.rand(*size) * 2 * k - k)
     
-    self.Wx = torch.rand(self.emb_size, self.hidden_size, device=self.device) * 2 * k - k
-    self.Wh = torch.rand(self.hidden_size, self.hidden_size, device=self.device) * 2 * k - k
-    self.Wy = torch.rand(self.hidden_size, self.vocab_size, device=self.device) * 2 * k - k
+    self.Wx = nn.ParameterList([uniform(n, self.hidden_size) for n in in_sizes])
+    # (Wy and by are created in the same order as always, so the same seed 
+    # gives the same initial parameters)
+    full = self.output_softmax != 'adaptive'
+    self.Wh = nn.ParameterList([uniform(self.hidden_size, self.hidden_size) for _ in in_sizes])
+    if full:
+        self.Wy = uniform(self.hidden_size, self.vocab_size)
     
-    self.bh = torch.rand(1, self.hidden_size, device=self.device) * 2 * k - k
-    self.by = torch.rand(1, self.vocab_size, device=self.device) * 2 * k - k
+    self.bh = nn.ParameterList([uniform(1, self.hidden_size) for _ in in_sizes])
+    if full:
+        self.by = uniform(1, self.vocab_size)
+    else:
+        self.adaptive = adaptive_softmax(self.hidden_size, self.vocab_size, self.adaptive_cutoffs)
 
 
   def init_hidden(self):
@@ -115,11 +403,15 @@ class RNN(nn.Module): # Implement a stacked vanilla RNN with Tanh nonlinearities
     """
     This is used for the first mini-batch in an epoch, only.
     """
-    hx = Variable(torch.zeros(self.num_layers, self.batch_size, self.hidden_size), requires_grad=True).cuda()
+    # Created on whichever device the model's parameters are on.
+    hx = self.wb.lut.weight.new_zeros(self.num_layers, self.batch_size, self.hidden_size)
     return hx
 
-  def step(self, x, h=None):
-    return self.tanh(torch.mm(x, self.Wx) + torch.mm(h, self.Wh) + self.bh)
+  def step(self, xp, h, Wh):
+    """
+    One time-step of one layer; xp is the precomputed x @ Wx + bh.
+    """
+    return self.cell(xp, h, Wh)
 
   def forward(self, inputs, hidden):
     # TODO ========================
@@ -157,23 +449,67 @@ class RNN(nn.Module): # Implement a stacked vanilla RNN with Tanh nonlinearities
               if you are curious.
                     shape: (num_layers, batch_size, hidden_size)
     """
-    outputs = Variable(torch.zeros(0, self.batch_size, self.vocab_size), requires_grad=True).cuda()
-#    hidden_new = hidden
-    hidden_new = copy.deepcopy(hidden).cuda()
-    for i in range(self.seq_len):
-        x = self.wb.forward(inputs[i])
-        x = self.dropout.forward(x)
-        for j in range(self.num_layers):
-            hidden_new[j] = self.step(x, hidden_new[j])
-            x = self.dropout.forward(x)
-        
-        output = torch.mm(hidden[-1], self.Wy) + self.by
-        outputs = torch.cat([outputs, torch.unsqueeze(output, 0)])
-    
-    return outputs, hidden_new
-#    return logits.view(self.seq_len, self.batch_size, self.vocab_size), hidden
+    # The layers are run one after the other over the whole sequence (rather 
+    # than interleaved at each time-step), which computes the same thing but 
+    # lets the input projections of every time-step be done in one matmul. 
+    # Only the recurrent matmul is left inside the time loop, and the output 
+    # projection is done once over (seq_len*batch_size, hidden_size).
+    seq_len, batch_size = inputs.size()
+    x, hidden = self.features(inputs, hidden)
+    logits = self.output(x.view(seq_len * batch_size, -1))
+    return logits.view(seq_len, batch_size, self.vocab_size), hidden
+
+  def features(self, inputs, hidden):
+    """
+    forward without the output layer: returns the (dropped-out) states of the 
+    top layer, shape (seq_len, batch_size, hidden_size), and the final hidden 
+    states. The training loop gives them to output_loss.
+    """
+    seq_len, batch_size = inputs.size()
+    x = self.dropout(self.wb(inputs))
+    hidden_new = []
+    for l in range(self.num_layers):
+        if self.linears is None:
+            xp = torch.addmm(self.bh[l], x.view(seq_len * batch_size, -1), self.Wx[l])
+            Wh = self.Wh[l]
+        else:
+            xp = self.linears['x%d' % l](x.view(seq_len * batch_size, -1))
+            Wh = self.linears['h%d' % l]
+        # (Wh=Wh binds this layer's: with checkpointing, step is called again 
+        # on the backward pass, after the loop has moved on)
+        states, h = run_recurrence(lambda xp_t, h, Wh=Wh: self.step(xp_t, h, Wh),
+                                   xp.view(seq_len, batch_size, -1), hidden[l],
+                                   self.checkpoint_steps)
+        hidden_new.append(h)
+        x = self.dropout(states)
+    return x, torch.stack(hidden_new)
+
+  def output(self, x):
+    """
+    The scores of every word for features x, shape (n, hidden_size): logits, 
+    or for the adaptive softmax log-probabilities (which are logits too).
+    """
+    if self.output_softmax == 'adaptive':
+        return adaptive_output(self.adaptive, x)
+    if self.linears is not None:
+        return self.linears['y'](x)
+    return torch.addmm(self.by, x, self.Wy)
 
-  def generate(self, input, hidden, generated_seq_len):
+  def output_loss(self, x, targets):
+    """
+    The loss (negative log-likelihood) of each of the targets, shape (n), 
+    given features x, shape (n, hidden_size). The sampled softmax is only 
+    sampled when training; otherwise this is the exact loss.
+    """
+    if self.output_softmax == 'adaptive':
+        return adaptive_output(self.adaptive, x, targets)
+    if self.output_softmax == 'sampled' and self.training:
+        return sampled_softmax_loss(x, targets, self.Wy.t(), self.by.view(-1), self.softmax_samples)
+    if self.loss_chunk_size > 0 and self.linears is None:
+        return chunked_cross_entropy(x, targets, self.Wy.t(), self.by.view(-1), self.loss_chunk_size)
+    return F.cross_entropy(self.output(x).float(), targets, reduction='none')
+
+  def generate(self, input, hidden, generated_seq_len, temperature=1., top_k=0, top_p=1., eos=None):
     # TODO ========================
     # Compute the forward pass, as in the self.forward method (above).
     # You'll probably want to copy substantial portions of that code here.
@@ -194,12 +530,22 @@ class RNN(nn.Module): # Implement a stacked vanilla RNN with Tanh nonlinearities
         - generated_seq_len: The length of the sequence to generate.
                        Note that this can be different than the length used 
                        for training (self.seq_len)
+        - temperature, top_k, top_p, eos: sampling options, see sample_next 
+                       and sample_sequences
     Returns:
         - Sampled sequences of tokens
                     shape: (generated_seq_len, batch_size)
     """
-   
-    return samples
+    # Every sequence in the batch is sampled at once, one time-step of 
+    # forward per token, carrying the hidden state from step to step. 
+    # Call model.eval() first to sample without dropout.
+    def next_logits(tokens):
+        nonlocal hidden
+        logits, hidden = self.forward(tokens.unsqueeze(0), hidden)
+        return logits[0]
+
+    with torch.no_grad():
+        return sample_sequences(next_logits, input, generated_seq_len, temperature, top_k, top_p, eos)
 
 
 # Problem 2
@@ -208,7 +554,8 @@ class GRU(nn.Module): # Implement a stacked GRU RNN
   Follow the same instructions as for RNN (above), but use the equations for 
   GRU, not Vanilla RNN.
   """
-  def __init__(self, emb_size, hidden_size, seq_len, batch_size, vocab_size, num_layers, dp_keep_prob):
+  def __init__(self, emb_size, hidden_size, seq_len, batch_size, vocab_size, num_layers, dp_keep_prob,
+               softmax='full', adaptive_cutoffs=(2000, 6000), softmax_samples=1024):
     super(GRU, self).__init__()
 
     self.emb_size = emb_size
@@ -218,6 +565,16 @@ class GRU(nn.Module): # Implement a stacked GRU RNN
     self.vocab_size = vocab_size
     self.num_layers = num_layers
     self.dp_keep_prob = dp_keep_prob
+    assert softmax in SOFTMAXES
+    self.output_softmax = softmax
+    self.adaptive_cutoffs = adaptive_cutoffs
+    self.softmax_samples = softmax_samples
+    # if > 0, the time loop is checkpointed in chunks of this many time-steps 
+    # (see run_recurrence), trading recomputation for memory when training
+    self.checkpoint_steps = 0
+    self.loss_chunk_size = 0  # see RNN.loss_chunk_size
+    self.cell = gru_cell  # see RNN.cell
+    self.linears = None
     
     self.wb = WordEmbedding(emb_size, vocab_size)
     self.dropout = nn.Dropout(1 - dp_keep_prob)
@@ -225,66 +582,125 @@ class GRU(nn.Module): # Implement a stacked GRU RNN
     
     self.sigmoid = torch.nn.Sigmoid()
     self.tanh = torch.nn.Tanh()
-    if torch.cuda.is_available():
-        self.device = torch.device("cuda") 
-    else:
-        self.device = torch.device("cpu")
-
     
     self.init_weights_uniform()
 
   def init_weights_uniform(self):
     # TODO ========================
     k = math.sqrt(1/self.hidden_size)
+    in_sizes = [self.emb_size] + [self.hidden_size] * (self.num_layers - 1)
+    def uniform(*size):
+        return torch.rand(*size) * 2 * k - k
     
-    self.Wr = torch.rand(self.emb_size, self.hidden_size, device=self.device) * 2 * k - k
-    self.Wz = torch.rand(self.emb_size, self.hidden_size, device=self.device) * 2 * k - k
-    self.Wh = torch.rand(self.emb_size, self.hidden_size, device=self.device) * 2 * k - k
-    self.Wy = torch.rand(self.hidden_size, self.vocab_size, device=self.device) * 2 * k - k
+    # The gates' weights are stacked: per layer, W = [Wr | Wz | Wh] (input), 
+    # b = [br | bz | bh], Urz = [Ur | Uz] (recurrent), and Uh, so that a 
+    # time-step is two matmuls (see gru_cell). They are drawn gate by gate, 
+    # in the same order as always, so the same seed gives the same model.
+    full = self.output_softmax != 'adaptive'  # see RNN.init_weights
+    Wr = [uniform(n, self.hidden_size) for n in in_sizes]
+    Wz = [uniform(n, self.hidden_size) for n in in_sizes]
+    Wh = [uniform(n, self.hidden_size) for n in in_sizes]
+    if full:
+        self.Wy = nn.Parameter(uniform(self.hidden_size, self.vocab_size))
     
-    self.Ur = torch.rand(self.hidden_size, self.hidden_size, device=self.device) * 2 * k - k
-    self.Uz = torch.rand(self.hidden_size, self.hidden_size, device=self.device) * 2 * k - k
-    self.Uh = torch.rand(self.hidden_size, self.hidden_size, device=self.device) * 2 * k - k
+    Ur = [uniform(self.hidden_size, self.hidden_size) for _ in in_sizes]
+    Uz = [uniform(self.hidden_size, self.hidden_size) for _ in in_sizes]
+    Uh = [uniform(self.hidden_size, self.hidden_size) for _ in in_sizes]
     
-    self.br = torch.rand(1, self.hidden_size, device=self.device) * 2 * k - k
-    self.bz = torch.rand(1, self.hidden_size, device=self.device) * 2 * k - k
-    self.bh = torch.rand(1, self.hidden_size, device=self.device) * 2 * k - k
-    self.by = torch.rand(1, self.vocab_size, device=self.device) * 2 * k - k
+    br = [uniform(1, self.hidden_size) for _ in in_sizes]
+    bz = [uniform(1, self.hidden_size) for _ in in_sizes]
+    bh = [uniform(1, self.hidden_size) for _ in in_sizes]
+    if full:
+        self.by = nn.Parameter(uniform(1, self.vocab_size))
+    else:
+        self.adaptive = adaptive_softmax(self.hidden_size, self.vocab_size, self.adaptive_cutoffs)
+
+    stack = lambda *gates: nn.ParameterList([nn.Parameter(torch.cat(g, 1)) for g in zip(*gates)])
+    self.W = stack(Wr, Wz, Wh)
+    self.b = stack(br, bz, bh)
+    self.Urz = stack(Ur, Uz)
+    self.Uh = nn.ParameterList([nn.Parameter(u) for u in Uh])
+
+  def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+    # Saved models from before the gates were stacked have them separately 
+    # (Wr, Wz, Wh, Ur, Uz, br, bz, bh); they are stacked here. (Uh is unchanged.)
+    for l in range(self.num_layers):
+        key = lambda name: '%s%s.%d' % (prefix, name, l)
+        if key('Wr') in state_dict:
+            pop = lambda *names: torch.cat([state_dict.pop(key(name)) for name in names], 1)
+            state_dict[key('W')] = pop('Wr', 'Wz', 'Wh')
+            state_dict[key('b')] = pop('br', 'bz', 'bh')
+            state_dict[key('Urz')] = pop('Ur', 'Uz')
+    super(GRU, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
   def init_hidden(self):
     # TODO ========================
-    hx = Variable(torch.zeros(self.num_layers, self.batch_size, self.hidden_size), requires_grad=True).cuda()
+    hx = self.wb.lut.weight.new_zeros(self.num_layers, self.batch_size, self.hidden_size)
     return hx
 
-  def step(self, x, h=None):
-    r = self.sigmoid(torch.mm(x, self.Wr) + torch.mm(h, self.Ur) + self.br)
-    z = self.sigmoid(torch.mm(x, self.Wz) + torch.mm(h, self.Uz) + self.bz)
-    h_ = self.tanh(torch.mm(x, self.Wh) + torch.mm(r ** h, self.Uh) + self.bh)
-    
-    return (1 - z) ** h + z ** h_
+  def step(self, xp, h, l):
+    """
+    One time-step of layer l; xp holds the precomputed input projections of 
+    the reset gate, update gate and candidate, concatenated along dim 1.
+    """
+    if self.linears is not None:
+        return self.cell(xp, h, self.linears['rz%d' % l], self.linears['h%d' % l])
+    return self.cell(xp, h, self.Urz[l], self.Uh[l])
 
   def forward(self, inputs, hidden):
     # TODO ========================
-    outputs = Variable(torch.zeros(0, self.batch_size, self.vocab_size), requires_grad=True).cuda()
-#    hidden_new = hidden
-    hidden_new = copy.deepcopy(hidden).cuda()
-    for i in range(self.seq_len):
-        x = self.wb.forward(inputs[i])
-        x = self.dropout.forward(x)
-#        print(x.shape)
-        for j in range(self.num_layers):
-            hidden_new[j] = self.step(x, hidden_new[j])
-            x = self.dropout.forward(x)
-        
-        output = torch.mm(hidden[-1], self.Wy) + self.by
-        outputs = torch.cat([outputs, torch.unsqueeze(output, 0)])
-    
-    return outputs, hidden_new
-#    return logits.view(self.seq_len, self.batch_size, self.vocab_size), hidden
-
-  def generate(self, input, hidden, generated_seq_len):
+    # See RNN.forward: the input projections of all three gates for the whole 
+    # sequence are done in a single matmul per layer.
+    seq_len, batch_size = inputs.size()
+    x, hidden = self.features(inputs, hidden)
+    logits = self.output(x.view(seq_len * batch_size, -1))
+    return logits.view(seq_len, batch_size, self.vocab_size), hidden
+
+  def features(self, inputs, hidden):
+    "See RNN.features."
+    seq_len, batch_size = inputs.size()
+    x = self.dropout(self.wb(inputs))
+    hidden_new = []
+    for l in range(self.num_layers):
+        if self.linears is None:
+            xp = torch.addmm(self.b[l], x.view(seq_len * batch_size, -1), self.W[l])
+        else:
+            xp = self.linears['x%d' % l](x.view(seq_len * batch_size, -1))
+        states, h = run_recurrence(lambda xp_t, h, l=l: self.step(xp_t, h, l),
+                                   xp.view(seq_len, batch_size, -1), hidden[l],
+                                   self.checkpoint_steps)
+        hidden_new.append(h)
+        x = self.dropout(states)
+    return x, torch.stack(hidden_new)
+
+  def output(self, x):
+    "See RNN.output."
+    if self.output_softmax == 'adaptive':
+        return adaptive_output(self.adaptive, x)
+    if self.linears is not None:
+        return self.linears['y'](x)
+    return torch.addmm(self.by, x, self.Wy)
+
+  def output_loss(self, x, targets):
+    "See RNN.output_loss."
+    if self.output_softmax == 'adaptive':
+        return adaptive_output(self.adaptive, x, targets)
+    if self.output_softmax == 'sampled' and self.training:
+        return sampled_softmax_loss(x, targets, self.Wy.t(), self.by.view(-1), self.softmax_samples)
+    if self.loss_chunk_size > 0 and self.linears is None:
+        return chunked_cross_entropy(x, targets, self.Wy.t(), self.by.view(-1), self.loss_chunk_size)
+    return F.cross_entropy(self.output(x).float(), targets, reduction='none')
+
+  def generate(self, input, hidden, generated_seq_len, temperature=1., top_k=0, top_p=1., eos=None):
     # TODO ========================
-    return samples
+    # See RNN.generate.
+    def next_logits(tokens):
+        nonlocal hidden
+        logits, hidden = self.forward(tokens.unsqueeze(0), hidden)
+        return logits[0]
+
+    with torch.no_grad():
+        return sample_sequences(next_logits, input, generated_seq_len, temperature, top_k, top_p, eos)
 
 
 # Problem 3
@@ -350,11 +766,14 @@ and a linear layer followed by a softmax.
 
 # TODO: implement this class
 class MultiHeadedAttention(nn.Module):
-    def __init__(self, n_heads, n_units, dropout=0.1):
+    def __init__(self, n_heads, n_units, dropout=0.1, backend='reference'):
         """
         n_heads: the number of attention heads
         n_units: the number of output units
         dropout: probability of DROPPING units
+        backend: how the attention itself is computed; 'reference' (the 
+                 implementation below) or 'sdpa' (torch's fused 
+                 scaled_dot_product_attention, where this torch has it)
         """
         # TODO: create/initialize any necessary parameters or layers
         # Initialize all weights and biases uniformly in the range [-k, k],
@@ -381,6 +800,12 @@ class MultiHeadedAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.softmax = nn.Softmax(dim=-1)
 
+        assert backend in ('reference', 'sdpa')
+        if backend == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+            print("WARNING: this torch has no scaled_dot_product_attention, using the reference attention")
+            backend = 'reference'
+        self.backend = backend
+
         self.log_debug = False
         print(("Init MultiHeadedAttention n_units=%s, n_heads=%s, d_k=%s, dropout=%s" % (n_units, n_heads, self.d_k, dropout)))
         
@@ -402,13 +827,16 @@ class MultiHeadedAttention(nn.Module):
             print("key size after MLP: %s" % str(self.k[0](key).size()))
             print("value size after MLP: %s" % str(self.v[0](value).size()))
 
-        k = self.k_linear(key).view(batch_size, -1, self.n_heads, self.d_k)
-        q = self.q_linear(query).view(batch_size, -1, self.n_heads, self.d_k)
-        v = self.v_linear(value).view(batch_size, -1, self.n_heads, self.d_k)
+        if query is key and key is value:
+            q, k, v = self.self_projections(query)
+        else:
+            k = self.k_linear(key).view(batch_size, -1, self.n_heads, self.d_k)
+            q = self.q_linear(query).view(batch_size, -1, self.n_heads, self.d_k)
+            v = self.v_linear(value).view(batch_size, -1, self.n_heads, self.d_k)
 
-        k = k.transpose(1,2)
-        q = q.transpose(1,2)
-        v = v.transpose(1,2)
+            k = k.transpose(1,2)
+            q = q.transpose(1,2)
+            v = v.transpose(1,2)
 
         scores = self.attention(q, k, v, mask, self.d_k)
 
@@ -418,11 +846,60 @@ class MultiHeadedAttention(nn.Module):
 
         return result # size: (batch_size, seq_len, self.n_units)
 
+    def self_projections(self, x):
+        """
+        Self-attention: all three projections of x in one matmul, against the 
+        stacked weights, split into q, k and v of size (batch_size, n_heads, seq_len, d_k).
+        """
+        if not isinstance(self.q_linear, nn.Linear):
+            # quantized (see quantize_model), so there are no weights to stack
+            return [linear(x).view(x.size(0), -1, self.n_heads, self.d_k).transpose(1, 2)
+                    for linear in (self.q_linear, self.k_linear, self.v_linear)]
+        weight = torch.cat([self.q_linear.weight, self.k_linear.weight, self.v_linear.weight])
+        bias = torch.cat([self.q_linear.bias, self.k_linear.bias, self.v_linear.bias])
+        qkv = F.linear(x, weight, bias).view(x.size(0), -1, 3, self.n_heads, self.d_k)
+        return qkv.permute(2, 0, 3, 1, 4).unbind(0)
+
+    def init_cache(self, batch_size, max_len, device=None, dtype=None):
+        """
+        Allocates the key/value cache for incremental decoding (see decode_step) 
+        of up to max_len positions, and empties it.
+        """
+        shape = (batch_size, self.n_heads, max_len, self.d_k)
+        self.cache_k = torch.zeros(shape, device=device, dtype=dtype)
+        self.cache_v = torch.zeros(shape, device=device, dtype=dtype)
+        self.cache_len = 0
+
+    def decode_step(self, x, mask=None):
+        """
+        Self-attention for new positions only: x holds the n positions that 
+        come after the cache_len already in the cache, size (batch_size, n, 
+        self.n_units). Their keys and values are added to the cache, and 
+        their queries attend to everything in it; mask, if given, has size 
+        (1, n, cache_len + n). The earlier positions are not recomputed.
+        """
+        batch_size, n, _ = x.size()
+        q, k, v = self.self_projections(x)
+        start, end = self.cache_len, self.cache_len + n
+        self.cache_k[:, :, start:end] = k
+        self.cache_v[:, :, start:end] = v
+        self.cache_len = end
+
+        scores = self.attention(q, self.cache_k[:, :, :end], self.cache_v[:, :, :end], mask, self.d_k)
+        concatenated = scores.transpose(1,2).contiguous().view(batch_size, -1, self.n_units)
+        return self.W0(concatenated)
+
     def attention(self, q, k, v, mask, d_k):
+        # q, k and v have size (batch_size, n_heads, seq_len, d_k)
+        if self.backend == 'sdpa':
+            return self.sdpa_attention(q, k, v, mask)
+        return self.reference_attention(q, k, v, mask, d_k)
+
+    def reference_attention(self, q, k, v, mask, d_k):
         x = torch.matmul(q, k.transpose(-2, -1)) /  math.sqrt(d_k)
-        x = x / math.sqrt(d_k)
-        mask = mask.unsqueeze(1)
-        x = x.masked_fill(mask == 0, -1e9)
+        if mask is not None:
+            mask = mask.unsqueeze(1)
+            x = x.masked_fill(mask == 0, -1e9)
 
         x =  self.softmax(x)
         x = self.dropout(x)
@@ -430,6 +907,27 @@ class MultiHeadedAttention(nn.Module):
 
         return x
 
+    def sdpa_attention(self, q, k, v, mask):
+        """
+        The same computation as the reference attention, done by 
+        F.scaled_dot_product_attention, which can pick a fused (flash or 
+        memory-efficient) kernel that never materializes the full 
+        (batch_size, n_heads, seq_len, seq_len) scores. The causal mask is 
+        passed as is_causal (which those kernels handle best) rather than 
+        as a tensor. Masks with a fully masked query row go to the 
+        reference attention.
+        """
+        dropout_p = self.dropout.p if self.training else 0.
+        if mask is not None and mask is subsequent_mask(mask.size(-1), mask.device):
+            return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True)
+        if mask is not None and not mask.bool().any(-1).all():
+            # A query with every key masked (e.g. padding at position 0): the 
+            # reference attends to all of them uniformly, sdpa would give NaN.
+            return self.reference_attention(q, k, v, mask, q.size(-1))
+        if mask is not None:
+            mask = mask.unsqueeze(1).bool()
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_p)
+
 
 
 
@@ -463,9 +961,10 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
         
-    def forward(self, x):
-        x = x + Variable(self.pe[:, :x.size(1)], 
-                         requires_grad=False).cuda()
+    def forward(self, x, start=0):
+        # pe is a buffer, so it is already on the same device as x.
+        # start is the position of x[:, 0], for decoding a few positions at a time.
+        x = x + self.pe[:, start:start + x.size(1)]
         return self.dropout(x)
 
 
@@ -486,6 +985,11 @@ class TransformerBlock(nn.Module):
         x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, mask)) # apply the self-attention
         return self.sublayer[1](x, self.feed_forward) # apply the position-wise MLP
 
+    def decode_step(self, x, mask=None):
+        "forward for new positions only, using the attention's key/value cache."
+        x = self.sublayer[0](x, lambda x: self.self_attn.decode_step(x, mask))
+        return self.sublayer[1](x, self.feed_forward)
+
 
 class TransformerStack(nn.Module):
     """
@@ -495,38 +999,149 @@ class TransformerStack(nn.Module):
         super(TransformerStack, self).__init__()
         self.layers = clones(layer, n_blocks)
         self.norm = LayerNorm(layer.size)
+        # With checkpoint=True (and gradients needed), only the input of each 
+        # block is kept for the backward pass, and the block's activations 
+        # are recomputed then: about one block's worth of activation memory 
+        # instead of n_blocks', for a second forward pass.
+        self.checkpoint = False
         
     def forward(self, x, mask):
         for layer in self.layers:
-            x = layer(x, mask)
+            if self.checkpoint and torch.is_grad_enabled():
+                x = torch.utils.checkpoint.checkpoint(layer, x, mask, use_reentrant=False)
+            else:
+                x = layer(x, mask)
+        return self.norm(x)
+
+    def decode_step(self, x, mask=None):
+        for layer in self.layers:
+            x = layer.decode_step(x, mask)
         return self.norm(x)
 
 
 class FullTransformer(nn.Module):
-    def __init__(self, transformer_stack, embedding, n_units, vocab_size):
+    def __init__(self, transformer_stack, embedding, n_units, vocab_size,
+                 softmax='full', adaptive_cutoffs=(2000, 6000), softmax_samples=1024):
         super(FullTransformer, self).__init__()
         self.transformer_stack = transformer_stack
         self.embedding = embedding
-        self.output_layer = nn.Linear(n_units, vocab_size)
+        # the output layer, see SOFTMAXES
+        assert softmax in SOFTMAXES
+        self.output_softmax = softmax
+        self.softmax_samples = softmax_samples
+        self.loss_chunk_size = 0  # see RNN.loss_chunk_size
+        if softmax == 'adaptive':
+            self.adaptive = adaptive_softmax(n_units, vocab_size, adaptive_cutoffs)
+        else:
+            self.output_layer = nn.Linear(n_units, vocab_size)
         
     def forward(self, input_sequence, mask):
-        embeddings = self.embedding(input_sequence)
-        return F.log_softmax(self.output_layer(self.transformer_stack(embeddings, mask)), dim=-1)
+        return self.output(self.features(input_sequence, mask))
+
+    def features(self, input_sequence, mask):
+        "forward without the output layer, size (batch_size, seq_len, n_units)."
+        return self.transformer_stack(self.embedding(input_sequence), mask)
+
+    def output(self, x):
+        "The log-probabilities of every word given features x (of any leading size)."
+        # the log_softmax is in fp32 even when the logits are bf16 (autocast)
+        if self.output_softmax == 'adaptive':
+            return adaptive_output(self.adaptive, x.reshape(-1, x.size(-1))).view(*x.shape[:-1], -1)
+        return F.log_softmax(self.output_layer(x).float(), dim=-1)
+
+    def output_loss(self, x, targets):
+        """
+        The loss of each of the targets, size (n), given features x, size 
+        (n, n_units); see RNN.output_loss.
+        """
+        if self.output_softmax == 'adaptive':
+            return adaptive_output(self.adaptive, x, targets)
+        if self.output_softmax == 'sampled' and self.training:
+            return sampled_softmax_loss(x, targets, self.output_layer.weight,
+                                        self.output_layer.bias, self.softmax_samples)
+        if self.loss_chunk_size > 0 and isinstance(self.output_layer, nn.Linear):
+            return chunked_cross_entropy(x, targets, self.output_layer.weight,
+                                         self.output_layer.bias, self.loss_chunk_size)
+        return F.nll_loss(self.output(x), targets, reduction='none')
+
+    def init_cache(self, batch_size, max_len):
+        """
+        Empties (and allocates) the per-layer key/value caches, to decode up to 
+        max_len positions with decode_step.
+        """
+        assert max_len <= self.embedding[1].pe.size(1)
+        param = self.embedding[0].lut.weight
+        for layer in self.transformer_stack.layers:
+            layer.self_attn.init_cache(batch_size, max_len, param.device, param.dtype)
+        self.cache_len = 0
+
+    def decode_step(self, tokens):
+        """
+        Incremental forward pass: tokens (batch_size, n) are the next n tokens 
+        after the cache_len already decoded since init_cache. Only these new 
+        positions go through the stack (attending to the cached keys/values of 
+        the earlier ones), so each step costs the same whatever the prefix length.
+
+        Returns the log-probabilities of the token after each of them, 
+        size (batch_size, n, vocab_size), as forward would for these positions.
+        """
+        start, n = self.cache_len, tokens.size(1)
+        if start == 0:
+            mask = subsequent_mask(n, tokens.device)
+        elif n == 1:
+            mask = None  # a single new position may attend to everything
+        else:
+            mask = torch.ones(1, n, start + n, dtype=torch.bool, device=tokens.device).tril(start)
+        word_embedding, position = self.embedding
+        x = position(word_embedding(tokens), start)
+        self.cache_len = start + n
+        return self.output(self.transformer_stack.decode_step(x, mask))
+
+    def generate(self, input, generated_seq_len, temperature=1., top_k=0, top_p=1., eos=None):
+        """
+        Samples generated_seq_len tokens following the seed tokens, using the 
+        key/value caches, so the seed goes through the model once and then each 
+        sampled token once. Call model.eval() first to sample without dropout.
+
+        Arguments:
+            - input: the seed tokens, shape (batch_size) or (batch_size, prefix_len)
+            - generated_seq_len: the number of tokens to sample
+            - temperature, top_k, top_p, eos: sampling options, see sample_next 
+                           and sample_sequences
+        Returns:
+            - Sampled sequences of tokens (as for RNN.generate)
+                        shape: (generated_seq_len, batch_size)
+        """
+        if input.dim() == 1:
+            input = input.unsqueeze(1)
+        batch_size, prefix_len = input.size()
+        def next_logits(tokens):
+            if tokens.dim() == 1:
+                tokens = tokens.unsqueeze(1)
+            return self.decode_step(tokens)[:, -1]
+
+        with torch.no_grad():
+            self.init_cache(batch_size, prefix_len + generated_seq_len)
+            return sample_sequences(next_logits, input, generated_seq_len, temperature, top_k, top_p, eos)
 
 
 def make_model(vocab_size, n_blocks=6, 
-               n_units=512, n_heads=16, dropout=0.1):
+               n_units=512, n_heads=16, dropout=0.1, attention_backend='reference',
+               softmax='full', adaptive_cutoffs=(2000, 6000), softmax_samples=1024):
     "Helper: Construct a model from hyperparameters."
     c = copy.deepcopy
     print("make_model %s %s %s" % (n_heads, n_units, vocab_size))
-    attn = MultiHeadedAttention(n_heads, n_units)
+    attn = MultiHeadedAttention(n_heads, n_units, backend=attention_backend)
     ff = MLP(n_units, dropout)
     position = PositionalEncoding(n_units, dropout)
     model = FullTransformer(
         transformer_stack=TransformerStack(TransformerBlock(n_units, c(attn), c(ff), dropout), n_blocks),
         embedding=nn.Sequential(WordEmbedding(n_units, vocab_size), c(position)),
         n_units=n_units,
-        vocab_size=vocab_size
+        vocab_size=vocab_size,
+        softmax=softmax,
+        adaptive_cutoffs=adaptive_cutoffs,
+        softmax_samples=softmax_samples
         )
     
     # Initialize parameters with Glorot / fan_avg.
@@ -536,16 +1151,217 @@ def make_model(vocab_size, n_blocks=6,
     return model
 
 
+def build_model(model, vocab_size, emb_size=200, hidden_size=200, seq_len=35, 
+                batch_size=20, num_layers=2, dp_keep_prob=1., attention_backend='reference',
+                softmax='full', adaptive_cutoffs=(2000, 6000), softmax_samples=1024):
+    """
+    Helper: construct any of the three models from the ptb-lm.py flags, as 
+    ptb-lm.py does (for the Transformer, hidden_size and num_layers are n_units 
+    and n_blocks). For the scripts that load and run saved models.
+    """
+    output = dict(softmax=softmax, adaptive_cutoffs=adaptive_cutoffs, softmax_samples=softmax_samples)
+    if model == 'RNN':
+        return RNN(emb_size=emb_size, hidden_size=hidden_size, seq_len=seq_len, 
+                   batch_size=batch_size, vocab_size=vocab_size, num_layers=num_layers, 
+                   dp_keep_prob=dp_keep_prob, **output)
+    elif model == 'GRU':
+        return GRU(emb_size=emb_size, hidden_size=hidden_size, seq_len=seq_len, 
+                   batch_size=batch_size, vocab_size=vocab_size, num_layers=num_layers, 
+                   dp_keep_prob=dp_keep_prob, **output)
+    elif model == 'TRANSFORMER':
+        transformer = make_model(vocab_size=vocab_size, n_units=hidden_size, n_blocks=num_layers, 
+                                 dropout=1. - dp_keep_prob, attention_backend=attention_backend,
+                                 **output)
+        # as in ptb-lm.py, only used by the code running the model
+        transformer.batch_size = batch_size
+        transformer.seq_len = seq_len
+        transformer.vocab_size = vocab_size
+        return transformer
+    raise ValueError("Model type not recognized: %s" % model)
+
+
+# How compile_model runs a model:
+#   eager:   op by op, as written (the default)
+#   script:  the recurrent cells, and the Transformer's LayerNorms and MLPs, 
+#            are scripted with TorchScript, which fuses their elementwise ops
+#   compile: the recurrent cells, and each whole Transformer block (and the 
+#            final LayerNorm), are compiled with torch.compile
+JIT_MODES = ('eager', 'script', 'compile')
+
+def _jit_parts(model, mode):
+    "Scripts or compiles (in place) the parts of model listed in JIT_MODES."
+    if isinstance(model, (RNN, GRU)):
+        if mode == 'script':
+            # (called through a Python function, which deepcopy shares, as 
+            # scripted functions cannot be copied)
+            scripted = torch.jit.script(model.cell)
+            model.cell = lambda *args: scripted(*args)
+        else:
+            model.cell = torch.compile(model.cell)
+    elif mode == 'script':
+        for parent in list(model.modules()):
+            for name, child in list(parent.named_children()):
+                if isinstance(child, (LayerNorm, MLP)):
+                    setattr(parent, name, torch.jit.script(child))
+    else:
+        for layer in model.transformer_stack.layers:
+            layer.compile()
+        model.transformer_stack.norm.compile()
+
+def _jit_check_pass(model, seq_len=5, batch_size=2):
+    """
+    The features and the parameters' gradients of model on a fixed random 
+    minibatch (without dropout), to compare eager and jitted execution.
+    """
+    param = next(model.parameters())
+    vocab_size = model.wb.lut.num_embeddings if isinstance(model, (RNN, GRU)) \
+        else model.embedding[0].lut.num_embeddings
+    generator = torch.Generator().manual_seed(0)
+    inputs = torch.randint(vocab_size, (seq_len, batch_size), generator=generator).to(param.device)
+    training = model.training
+    model.eval()
+    model.zero_grad(set_to_none=True)
+    if isinstance(model, (RNN, GRU)):
+        hidden = param.new_zeros(model.num_layers, batch_size, model.hidden_size)
+        features = model.features(inputs, hidden)[0]
+    else:
+        features = model.features(inputs.t(), subsequent_mask(seq_len, param.device))
+    features.float().sum().backward()
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    model.zero_grad(set_to_none=True)
+    model.train(training)
+    return [features.detach()] + grads
+
+def compile_model(model, mode='compile', check=True, rtol=1e-4, atol=1e-5):
+    """
+    Opt-in scripted or compiled execution of model (see JIT_MODES), for the 
+    RNN, GRU and Transformer. Returns (model, the mode in use): model is a 
+    jitted copy of the model that was given, or, if jitting it fails, or 
+    with check its features or gradients on a test minibatch do not match 
+    the eager model's (within rtol and atol), the model itself, run eagerly 
+    (with a warning). Call this before creating the optimizer, since the 
+    copy has its own parameters.
+    """
+    assert mode in JIT_MODES
+    if mode == 'eager':
+        return model, mode
+    jitted = copy.deepcopy(model)
+    try:
+        _jit_parts(jitted, mode)
+        if check:
+            expected = _jit_check_pass(model)
+            actual = _jit_check_pass(jitted)
+            if not all(torch.allclose(a, e, rtol=rtol, atol=atol) for a, e in zip(actual, expected)):
+                print("WARNING: the %s model does not match the eager one, running it eagerly" % mode)
+                return model, 'eager'
+    except Exception as e:
+        print("WARNING: could not %s the model (%s: %s), running it eagerly" % (mode, type(e).__name__, e))
+        return model, 'eager'
+    return jitted, mode
+
+
+# How quantize_model quantizes the matmuls to int8:
+#   dynamic: the weights ahead of time, the activations on the fly (each 
+#            input's own range)
+#   static:  the activations too, with ranges fixed by calibration
+QUANTIZATIONS = ('dynamic', 'static')
+
+def _as_linear(W, b=None):
+    "An nn.Linear computing x @ W (+ b), for a weight matrix W stored (in, out), as the RNN and GRU store them."
+    linear = nn.Linear(W.size(0), W.size(1), bias=b is not None)
+    with torch.no_grad():
+        linear.weight.copy_(W.t())
+        if b is not None:
+            linear.bias.copy_(b.view(-1))
+    return linear
+
+def _move_to_linears(model):
+    """
+    Replaces the weight matrices of an RNN or GRU (input, recurrent and, 
+    with the full softmax, output) with the same matmuls as nn.Linears, in 
+    model.linears, which is what torch's quantization works on.
+    """
+    linears = nn.ModuleDict()
+    if isinstance(model, RNN):
+        names = ['Wx', 'Wh', 'bh']
+        for l in range(model.num_layers):
+            linears['x%d' % l] = _as_linear(model.Wx[l], model.bh[l])
+            linears['h%d' % l] = _as_linear(model.Wh[l])
+        model.cell = linear_rnn_cell
+    else:
+        names = ['W', 'b', 'Urz', 'Uh']
+        for l in range(model.num_layers):
+            linears['x%d' % l] = _as_linear(model.W[l], model.b[l])
+            linears['rz%d' % l] = _as_linear(model.Urz[l])
+            linears['h%d' % l] = _as_linear(model.Uh[l])
+        model.cell = linear_gru_cell
+    if model.output_softmax != 'adaptive':
+        names += ['Wy', 'by']
+        linears['y'] = _as_linear(model.Wy, model.by)
+    for name in names:
+        delattr(model, name)
+    model.linears = linears
+
+def _calibrate(model, batches):
+    "Runs model (in eval mode) over batches of token ids, shape (seq_len, batch_size), for static quantization."
+    hidden = None
+    with torch.no_grad():
+        for inputs in batches:
+            if isinstance(model, (RNN, GRU)):
+                if hidden is None or hidden.size(1) != inputs.size(1):
+                    model.batch_size = inputs.size(1)
+                    hidden = model.init_hidden()
+                _, hidden = model(inputs, hidden)
+            else:
+                model(inputs.t(), subsequent_mask(inputs.size(0)))
+
+def quantize_model(model, mode='dynamic', calibration_batches=()):
+    """
+    An int8-quantized copy of model (RNN, GRU or Transformer), for inference 
+    on the cpu: every matmul with a weight matrix (the linear layers, and 
+    the RNN's and GRU's input, recurrent and output matrices) is done in 
+    int8, as QUANTIZATIONS[mode]. Static quantization calibrates on 
+    calibration_batches, token ids of shape (seq_len, batch_size). The 
+    embeddings, LayerNorms and nonlinearities stay fp32, and the copy can 
+    only be used for inference (and saved whole, with torch.save).
+    """
+    assert mode in QUANTIZATIONS
+    model = copy.deepcopy(model).cpu().eval()
+    if isinstance(model, (RNN, GRU)):
+        _move_to_linears(model)
+    if mode == 'dynamic':
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    # Each linear layer gets its input quantized, and its output dequantized.
+    qconfig = torch.ao.quantization.get_default_qconfig(torch.backends.quantized.engine)
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, nn.Linear):
+                wrapped = nn.Sequential(torch.ao.quantization.QuantStub(), child,
+                                        torch.ao.quantization.DeQuantStub())
+                wrapped.qconfig = qconfig
+                setattr(parent, name, wrapped)
+    torch.ao.quantization.prepare(model, inplace=True)
+    _calibrate(model, calibration_batches)
+    return torch.ao.quantization.convert(model, inplace=True)
+
+
 #----------------------------------------------------------------------------------
 # Data processing
 
-def subsequent_mask(size):
-    """ helper function for creating the masks. """
-    attn_shape = (1, size, size)
-    subsequent_mask = np.triu(np.ones(attn_shape), k=1).astype('uint8')
-    print("subsequent_mask %s" % attn_shape)
-    print("subsequent_mask %s" % subsequent_mask)
-    return torch.from_numpy(subsequent_mask) == 0
+# Causal masks by (size, device, dtype); they are the same for every minibatch.
+_subsequent_masks = {}
+
+def subsequent_mask(size, device=None, dtype=torch.bool):
+    """
+    helper function for creating the masks: shape (1, size, size), true where 
+    position i may attend to position j (j <= i). Each mask is built once and 
+    cached, so the result is shared and must not be modified in place.
+    """
+    key = (size, torch.device(device) if device is not None else torch.device('cpu'), dtype)
+    if key not in _subsequent_masks:
+        mask = torch.ones(1, size, size, dtype=torch.bool, device=device).tril()
+        _subsequent_masks[key] = mask.to(dtype)
+    return _subsequent_masks[key]
 
 class Batch:
     "Object for holding a batch of data with mask during training."
@@ -555,11 +1371,18 @@ class Batch:
     
     @staticmethod
     def make_mask(data, pad):
-        "Create a mask to hide future words."
-        mask = (data != pad).unsqueeze(-2)
-        mask = mask & Variable(
-            subsequent_mask(data.size(-1)).type_as(mask.data))
-        return mask
+        """
+        Create a mask to hide future words (and padding). When there can be 
+        no padding this is the cached causal mask, of shape (1, seq_len, seq_len), 
+        which broadcasts over the batch; otherwise (batch_size, seq_len, seq_len).
+        """
+        mask = subsequent_mask(data.size(-1), data.device)
+        # Token ids are never negative, so then there is nothing to hide. On 
+        # the cpu checking for pad tokens is cheaper than the AND; on the GPU 
+        # it would cost a device sync, so we just do the AND.
+        if pad < 0 or (data.device.type == 'cpu' and not bool((data == pad).any())):
+            return mask
+        return (data != pad).unsqueeze(-2) & mask
 
 
 #----------------------------------------------------------------------------------
@@ -574,9 +1397,12 @@ class LayerNorm(nn.Module):
         self.eps = eps
 
     def forward(self, x):
+        # Always computed in fp32 (also under bf16 autocast), for stability.
+        dtype = x.dtype
+        x = x.float()
         mean = x.mean(-1, keepdim=True)
         std = x.std(-1, keepdim=True)
-        return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
+        return (self.a_2 * (x - mean) / (std + self.eps) + self.b_2).to(dtype)
 
 
 class ResidualSkipConnectionWithLayerNorm(nn.Module):
@@ -81,11 +81,14 @@
 import argparse
 import time
 import collections
+import contextlib
 import os
+import random
 import sys
+import threading
 import torch
+import torch.distributed as dist
 import torch.nn
-from torch.autograd import Variable
 import torch.nn as nn
 import numpy
 np = numpy
@@ -93,7 +96,10 @@ np = numpy
 # NOTE ==============================================
 # This is where your models are imported
 from models import RNN, GRU 
+from models import Batch
+from models import compile_model
 from models import make_model as TRANSFORMER
+from reader import ptb_raw_data, TensorBatches
 
 
 ##############################################################################
@@ -141,6 +147,80 @@ parser.add_argument('--save_dir', type=str, default='',
                     This is automatically generated based on the command line \
                     arguments you pass and only needs to be set if you want a \
                     custom dir name')
+parser.add_argument('--precision', type=str, default='fp32',
+                    help='fp32, or bf16 to run the models under bf16 autocast \
+                    (layer norms and the loss stay in fp32)')
+parser.add_argument('--attention_backend', type=str, default='reference',
+                    help='how TRANSFORMER computes attention; reference, or sdpa \
+                    for torch\'s fused scaled_dot_product_attention')
+parser.add_argument('--softmax', type=str, default='full',
+                    help='output layer: full, adaptive (an adaptive softmax over \
+                    frequency clusters), or sampled (a full softmax trained with \
+                    a sampled softmax loss; the reported training perplexity is \
+                    then that of the sampled loss, validation stays exact)')
+parser.add_argument('--adaptive_cutoffs', type=str, default='2000,6000',
+                    help='comma-separated word ids at which the adaptive softmax \
+                    clusters start (the ids are in order of frequency)')
+parser.add_argument('--softmax_samples', type=int, default=1024,
+                    help='number of words sampled per minibatch by --softmax=sampled')
+parser.add_argument('--micro_batch_size', type=int, default=None,
+                    help='if given, each minibatch of batch_size sequences is \
+                    run micro_batch_size sequences at a time, accumulating the \
+                    gradients, so batch_size is the effective batch size but \
+                    only a micro-batch\'s activations are in memory at once')
+parser.add_argument('--checkpoint_steps', type=int, default=0,
+                    help='RNN/GRU: if > 0, use activation checkpointing on the \
+                    time loop, in chunks of this many time-steps (less memory, \
+                    some recomputation)')
+parser.add_argument('--checkpoint_blocks', action='store_true',
+                    help='TRANSFORMER: use activation checkpointing on each \
+                    transformer block (less memory, some recomputation)')
+parser.add_argument('--loss_chunk_size', type=int, default=0,
+                    help='if > 0, compute the (full softmax) loss this many tokens \
+                    at a time, never holding the logits of the whole minibatch \
+                    (less memory, one more output matmul on the backward pass)')
+parser.add_argument('--sparse_embedding', action='store_true',
+                    help='sparse gradients for the word embeddings: only the rows \
+                    of the words in each minibatch are updated (with ADAM, the \
+                    embeddings then get SparseAdam, which also only updates \
+                    those rows\' moments)')
+parser.add_argument('--jit', type=str, default='eager',
+                    help='eager, script (TorchScript the recurrent cells, or the \
+                    Transformer\'s LayerNorms and MLPs) or compile (torch.compile \
+                    them, or each Transformer block); falls back to eager if \
+                    that fails or does not match the eager model')
+parser.add_argument('--no_data_cache', action='store_true',
+                    help='re-tokenize the data instead of using (and writing) \
+                    the token-id cache in <data>/.cache')
+parser.add_argument('--prefetch', action='store_true',
+                    help='keep the data in host memory (memory-mapped from the \
+                    cache) and copy each minibatch to the GPU ahead of time, \
+                    instead of moving all of it to the GPU up front')
+parser.add_argument('--device', type=str, default=None,
+                    help='device to run on, e.g. cpu, cuda or cuda:1. Defaults \
+                    to the GPU if there is one, otherwise the cpu.')
+parser.add_argument('--distributed', action='store_true',
+                    help='data-parallel training over several processes, started \
+                    by a launcher such as torchrun (see DISTRIBUTED SETUP below); \
+                    batch_size is then the total over all the processes')
+parser.add_argument('--dist_backend', type=str, default='gloo',
+                    help='torch.distributed backend for --distributed (gloo \
+                    works on cpu-only hosts)')
+parser.add_argument('--profile', action='store_true',
+                    help='time each phase of the steps (data, forward, loss, \
+                    backward, all_reduce, clip, optimizer, sync) and write a \
+                    summary of every epoch to <save_dir>/profile.txt')
+parser.add_argument('--trace_steps', type=int, default=0,
+                    help='if > 0, record this many training steps of the first \
+                    epoch (after 10 warmup steps) with torch.profiler, and \
+                    save them as a Chrome trace in <save_dir>/trace.json')
+parser.add_argument('--save_every', type=int, default=1,
+                    help='write a full checkpoint (model, optimizer, lr schedule, \
+                    random number generators and learning curves) to \
+                    <save_dir>/checkpoint.pt every this many epochs (0: never)')
+parser.add_argument('--resume', type=str, default='',
+                    help='experiment dir of an interrupted run to resume from \
+                    its checkpoint.pt; pass the same flags as that run')
 parser.add_argument('--evaluate', action='store_true',
                     help="use this flag to run on the test set. Only do this \
                     ONCE for each model setting, and only after you've \
@@ -153,40 +233,70 @@ parser.add_argument('--seed', type=int, default=1111,
                     help='random seed')
 
 args = parser.parse_args()
+if args.sparse_embedding and args.distributed:
+    parser.error('--sparse_embedding does not work with --distributed (the gradients are all-reduced as one dense tensor)')
 argsdict = args.__dict__
 argsdict['code_file'] = sys.argv[0]
 
+# DISTRIBUTED SETUP
+# With --distributed, this script runs once per process, started by a 
+# launcher that sets RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT; e.g. with 
+# 4 processes on one host:
+#    torchrun --nproc_per_node=4 ptb-lm.py --distributed --model=GRU ...
+# Each process trains the same model on its own batch_size/world_size of the 
+# sequences, the gradients are averaged over the processes before every 
+# update (see all_reduce_gradients), and the losses are averaged at the end of 
+# every epoch. Only rank 0 prints and writes files.
+if args.distributed:
+    dist.init_process_group(args.dist_backend)
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+else:
+    rank, world_size = 0, 1
+if rank != 0:
+    sys.stdout = open(os.devnull, 'w')
+
 # Use the model, optimizer, and the flags passed to the script to make the 
 # name for the experimental dir
 print("\n########## Setting Up Experiment ######################")
-flags = [flag.lstrip('--') for flag in sys.argv[1:]]
+# (path separators in the flags, e.g. in --data, would make it a path)
+flags = [flag.lstrip('--').replace(os.sep, '_') for flag in sys.argv[1:]]
 experiment_path = os.path.join(args.save_dir+'_'.join([argsdict['model'],
                                          argsdict['optimizer']] 
                                          + flags))
 
-# Increment a counter so that previous results with the same args will not
-# be overwritten. Comment out the next four lines if you only want to keep
-# the most recent results.
-i = 0
-while os.path.exists(experiment_path + "_" + str(i)):
-    i += 1
-experiment_path = experiment_path + "_" + str(i)
-
-# Creates an experimental directory and dumps all the args to a text file
-os.mkdir(experiment_path)
-print ("\nPutting log in %s"%experiment_path)
-argsdict['save_dir'] = experiment_path
-with open (os.path.join(experiment_path,'exp_config.txt'), 'w') as f:
-    for key in sorted(argsdict):
-        f.write(key+'    '+str(argsdict[key])+'\n')
+if args.resume:
+    # carry on in the interrupted run's dir (and log)
+    experiment_path = args.resume.rstrip(os.sep)
+    print ("\nResuming %s"%experiment_path)
+    argsdict['save_dir'] = experiment_path
+elif rank == 0:
+    # Increment a counter so that previous results with the same args will not
+    # be overwritten. Comment out the next four lines if you only want to keep
+    # the most recent results.
+    i = 0
+    while os.path.exists(experiment_path + "_" + str(i)):
+        i += 1
+    experiment_path = experiment_path + "_" + str(i)
+
+    # Creates an experimental directory and dumps all the args to a text file
+    os.mkdir(experiment_path)
+    print ("\nPutting log in %s"%experiment_path)
+    argsdict['save_dir'] = experiment_path
+    with open (os.path.join(experiment_path,'exp_config.txt'), 'w') as f:
+        for key in sorted(argsdict):
+            f.write(key+'    '+str(argsdict[key])+'\n')
 
 # Set the random seed manually for reproducibility.
 torch.manual_seed(args.seed)
 
-# Use the GPU if you have one
-if torch.cuda.is_available():
+# Use the GPU if you have one (unless a device was asked for)
+if args.device is not None:
+    print("Using device " + args.device)
+    device = torch.device(args.device)
+elif torch.cuda.is_available():
     print("Using the GPU")
-    device = torch.device("cuda") 
+    # (one GPU per process on each host, when distributed)
+    device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0))) 
 else:
     print("WARNING: You are about to run on cpu, and this will likely run out \
       of memory. \n You can try setting batch_size=1 to reduce memory usage")
@@ -199,89 +309,25 @@ else:
 #
 ###############################################################################
 
-# HELPER FUNCTIONS
-def _read_words(filename):
-    with open(filename, "r") as f:
-      return f.read().replace("\n", "<eos>").split()
-
-def _build_vocab(filename):
-    data = _read_words(filename)
-
-    counter = collections.Counter(data)
-    count_pairs = sorted(counter.items(), key=lambda x: (-x[1], x[0]))
-
-    words, _ = list(zip(*count_pairs))
-    word_to_id = dict(zip(words, range(len(words))))
-    id_to_word = dict((v, k) for k, v in word_to_id.items())
-
-    return word_to_id, id_to_word
-
-def _file_to_word_ids(filename, word_to_id):
-    data = _read_words(filename)
-    return [word_to_id[word] for word in data if word in word_to_id]
-
-# Processes the raw data from text files
-def ptb_raw_data(data_path=None, prefix="ptb"):
-    train_path = os.path.join(data_path, prefix + ".train.txt")
-    valid_path = os.path.join(data_path, prefix + ".valid.txt")
-    test_path = os.path.join(data_path, prefix + ".test.txt")
-
-    word_to_id, id_2_word = _build_vocab(train_path)
-    train_data = _file_to_word_ids(train_path, word_to_id)
-    valid_data = _file_to_word_ids(valid_path, word_to_id)
-    test_data = _file_to_word_ids(test_path, word_to_id)
-    return train_data, valid_data, test_data, word_to_id, id_2_word
-
-# Yields minibatches of data
-def ptb_iterator(raw_data, batch_size, num_steps):
-    raw_data = np.array(raw_data, dtype=np.int32)
-
-    data_len = len(raw_data)
-    batch_len = data_len // batch_size
-    data = np.zeros([batch_size, batch_len], dtype=np.int32)
-    for i in range(batch_size):
-        data[i] = raw_data[batch_len * i:batch_len * (i + 1)]
-
-    epoch_size = (batch_len - 1) // num_steps
-
-    if epoch_size == 0:
-        raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
-
-    for i in range(epoch_size):
-        x = data[:, i*num_steps:(i+1)*num_steps]
-        y = data[:, i*num_steps+1:(i+1)*num_steps+1]
-        yield (x, y)
-
-
-class Batch:
-    "Data processing for the transformer. This class adds a mask to the data."
-    def __init__(self, x, pad=-1):
-        self.data = x
-        self.mask = self.make_mask(self.data, pad)
-    
-    @staticmethod
-    def make_mask(data, pad):
-        "Create a mask to hide future words."
-
-        def subsequent_mask(size):
-            """ helper function for creating the masks. """
-            attn_shape = (1, size, size)
-            subsequent_mask = np.triu(np.ones(attn_shape), k=1).astype('uint8')
-            return torch.from_numpy(subsequent_mask) == 0
-
-        mask = (data != pad).unsqueeze(-2)
-        mask = mask & Variable(
-            subsequent_mask(data.size(-1)).type_as(mask.data))
-        return mask
-
-
 # LOAD DATA
 print('Loading data from '+args.data)
-raw_data = ptb_raw_data(data_path=args.data)
+raw_data = ptb_raw_data(data_path=args.data, cache=not args.no_data_cache)
 train_data, valid_data, test_data, word_to_id, id_2_word = raw_data
 vocab_size = len(word_to_id)
 print('  vocabulary size: {}'.format(vocab_size))
 
+# The minibatches are laid out (and moved to the GPU) once, and reused every 
+# epoch; on the cpu, or with --prefetch, they are instead read from the 
+# memory-mapped data one at a time (see TensorBatches). When distributed, 
+# each process only has its share of the sequences (columns) of every 
+# minibatch.
+train_batches = TensorBatches(train_data, args.batch_size, args.seq_len, device, args.prefetch,
+                              rank, world_size)
+valid_batches = TensorBatches(valid_data, args.batch_size, args.seq_len, device, args.prefetch,
+                              rank, world_size)
+# the number of sequences in this process's minibatches
+batch_size = train_batches.batch_size
+
 
 ###############################################################################
 # 
@@ -289,49 +335,122 @@ print('  vocabulary size: {}'.format(vocab_size))
 #
 ###############################################################################
 
+# The output layer (softmax) options, the same for the three models
+output_args = dict(softmax=args.softmax, softmax_samples=args.softmax_samples,
+                   adaptive_cutoffs=[int(c) for c in args.adaptive_cutoffs.split(',')])
+
 # NOTE ==============================================
 # This is where your model code will be called. You may modify this code
 # if required for your implementation, but it should not typically be necessary,
 # and you must let the TAs know if you do so.
 if args.model == 'RNN':
     model = RNN(emb_size=args.emb_size, hidden_size=args.hidden_size, 
-                seq_len=args.seq_len, batch_size=args.batch_size,
+                seq_len=args.seq_len, batch_size=batch_size,
                 vocab_size=vocab_size, num_layers=args.num_layers, 
-                dp_keep_prob=args.dp_keep_prob) 
+                dp_keep_prob=args.dp_keep_prob, **output_args) 
 elif args.model == 'GRU':
     model = GRU(emb_size=args.emb_size, hidden_size=args.hidden_size, 
-                seq_len=args.seq_len, batch_size=args.batch_size,
+                seq_len=args.seq_len, batch_size=batch_size,
                 vocab_size=vocab_size, num_layers=args.num_layers, 
-                dp_keep_prob=args.dp_keep_prob)
+                dp_keep_prob=args.dp_keep_prob, **output_args)
 elif args.model == 'TRANSFORMER':
     if args.debug:  # use a very small model
-        model = TRANSFORMER(vocab_size=vocab_size, n_units=16, n_blocks=2)
+        model = TRANSFORMER(vocab_size=vocab_size, n_units=16, n_blocks=2,
+                            attention_backend=args.attention_backend, **output_args)
     else:
         # Note that we're using num_layers and hidden_size to mean slightly 
         # different things here than in the RNNs.
         # Also, the Transformer also has other hyperparameters 
         # (such as the number of attention heads) which can change it's behavior.
         model = TRANSFORMER(vocab_size=vocab_size, n_units=args.hidden_size, 
-                            n_blocks=args.num_layers, dropout=1.-args.dp_keep_prob) 
+                            n_blocks=args.num_layers, dropout=1.-args.dp_keep_prob,
+                            attention_backend=args.attention_backend, **output_args) 
     # these 3 attributes don't affect the Transformer's computations; 
     # they are only used in run_epoch
-    model.batch_size=args.batch_size
+    model.batch_size=batch_size
     model.seq_len=args.seq_len
     model.vocab_size=vocab_size
 else:
   print("Model type not recognized.")
 
+# Activation checkpointing (only has an effect when training), and the chunked loss
+if args.model == 'TRANSFORMER':
+    model.transformer_stack.checkpoint = args.checkpoint_blocks
+else:
+    model.checkpoint_steps = args.checkpoint_steps
+model.loss_chunk_size = args.loss_chunk_size
+
+# Sparse embedding gradients (see coalesce_sparse_gradients)
+for m in model.modules():
+    if isinstance(m, nn.Embedding):
+        m.sparse = args.sparse_embedding
+
 model = model.to(device)
 
+if world_size > 1:
+    # Every process starts from rank 0's parameters (they are the same anyway, 
+    # from the same seed), but draws different dropout masks.
+    for p in model.state_dict().values():
+        dist.broadcast(p, 0)
+    torch.manual_seed(args.seed + rank)
+
+# Scripted / compiled execution (checked against eager on a test minibatch)
+if args.jit != 'eager':
+    model, jit_mode = compile_model(model, args.jit)
+    print('Running the model with --jit=%s' % jit_mode)
+
 # LOSS FUNCTION
-loss_fn = nn.CrossEntropyLoss()
-if args.optimizer == 'ADAM':
-    optimizer = torch.optim.Adam(model.parameters(), lr=args.initial_lr)
+# The models compute the loss themselves (model.output_loss), from the 
+# features under their output layer, since with --softmax=adaptive or sampled 
+# the loss is computed without the logits of the whole vocabulary. It is the 
+# loss of every token, so that run_epoch can also accumulate the loss at each 
+# time-step (position in the sequence).
+
+# OPTIMIZER
+# foreach=True makes the optimizers (and the gradient clipping in run_epoch) 
+# use multi-tensor kernels: a few fused ops over all the parameters instead 
+# of a Python loop with several small ops per parameter tensor.
+# Plain SGD (no momentum or weight decay) is the same update as p -= lr * grad.
+# With --sparse_embedding, SGD only updates the rows in the (sparse) 
+# gradient, and since Adam cannot take sparse gradients, the embeddings get 
+# SparseAdam (a "lazy" Adam, which only updates the moments of those rows).
+class Optimizers:
+    "Several optimizers, over different parameters, used as one."
+    def __init__(self, *optimizers):
+        self.optimizers = optimizers
+        self.param_groups = [group for o in optimizers for group in o.param_groups]
+
+    def step(self):
+        for o in self.optimizers:
+            o.step()
+
+    def state_dict(self):
+        return [o.state_dict() for o in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for o, state_dict in zip(self.optimizers, state_dicts):
+            o.load_state_dict(state_dict)
+
+if args.optimizer == 'ADAM' and args.sparse_embedding:
+    # (from the final model: --jit runs a copy of the one built above)
+    embeddings = [m.weight for m in model.modules() if isinstance(m, nn.Embedding)]
+    dense = [p for p in model.parameters() if all(p is not e for e in embeddings)]
+    optimizer = Optimizers(torch.optim.SparseAdam(embeddings, lr=args.initial_lr),
+                           torch.optim.Adam(dense, lr=args.initial_lr, foreach=True))
+elif args.optimizer == 'ADAM':
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.initial_lr, foreach=True)
+else:
+    optimizer = torch.optim.SGD(model.parameters(), lr=args.initial_lr, foreach=True)
 
 # LEARNING RATE SCHEDULE    
-lr = args.initial_lr
 lr_decay_base = 1 / 1.15
 m_flat_lr = 14.0 # we will not touch lr for the first m_flat_lr epochs
+# Stepped at the end of every epoch: the lr for the next epoch is the current 
+# one times lr_decay_base ** max(epoch - m_flat_lr, 0).
+scheduler = None
+if args.optimizer == 'SGD_LR_SCHEDULE':
+    scheduler = torch.optim.lr_scheduler.MultiplicativeLR(
+        optimizer, lambda epoch: lr_decay_base ** max(epoch - m_flat_lr, 0))
 
 
 ###############################################################################
@@ -352,70 +471,287 @@ def repackage_hidden(h):
     the mini-batches are actually successive subsequences in a set of longer sequences.
     This is the case with the way we've processed the Penn Treebank dataset.
     """
-    if isinstance(h, Variable):
+    if isinstance(h, torch.Tensor):
         return h.detach_()
     else:
         return tuple(repackage_hidden(v) for v in h)
 
 
-def run_epoch(model, data, is_train=False, lr=1.0):
+def all_reduce_gradients(model):
+    """
+    Averages the gradients over the processes, when distributed, so that 
+    every process takes the same step: that of the mean loss over all their 
+    minibatches (which are the same size). All the gradients go in one 
+    flattened all-reduce, rather than one per parameter.
+
+    A parameter without a gradient on this process (e.g. a tail cluster of 
+    the adaptive softmax with no targets in its minibatch) gets a zero one, 
+    so that every process sends the same parameters in the same layout.
+    """
+    params = [p for p in model.parameters() if p.requires_grad]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    grads = [p.grad for p in params]
+    flat = torch.cat([g.flatten() for g in grads])
+    dist.all_reduce(flat)
+    flat /= world_size
+    for g, g_ in zip(grads, flat.split([g.numel() for g in grads])):
+        g.copy_(g_.view_as(g))
+
+
+def coalesce_sparse_gradients(model):
+    """
+    With --sparse_embedding, the embeddings' gradients are sparse, with one 
+    row per token of the minibatch (repeated words included). They are 
+    coalesced (the repeats summed) once here, which the gradient clipping's 
+    norm and the optimizer would otherwise each do.
+    """
+    for p in model.parameters():
+        if p.grad is not None and p.grad.is_sparse:
+            p.grad = p.grad.coalesce()
+
+
+class CheckpointWriter:
+    """
+    Saves (torch.save) in a background thread, so training goes on while 
+    checkpoints are written. Each file is written to a temporary name and 
+    then renamed, so a run killed mid-write leaves the previous version 
+    intact. At most one save is in flight; save waits for the previous one.
+    """
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, files):
+        """ files maps paths to what to save there. """
+        self.wait()
+        # Copied to the cpu here, before training changes the tensors (and 
+        # so the thread needs no device).
+        files = {path: cpu_copy(obj) for path, obj in files.items()}
+        self.thread = threading.Thread(target=self._write, args=(files,))
+        self.thread.start()
+
+    def _write(self, files):
+        try:
+            for path, obj in files.items():
+                torch.save(obj, path + '.tmp')
+                os.replace(path + '.tmp', path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def cpu_copy(obj):
+    "A copy of obj, any nesting of dicts, lists and tuples, with its tensors copied to the cpu."
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    "The states of all the random number generators, for the checkpoints."
+    return {'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            'numpy': np.random.get_state(),
+            'random': random.getstate()}
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+
+
+class PhaseTimer:
+    """
+    Adds up the wall-clock time spent in each phase of the steps, for 
+    --profile: "with timer('forward'): ..." adds the time of the block to 
+    forward. When disabled it only costs a function call per phase.
+
+    On the GPU the device is synchronized before and after every phase, so 
+    the time of its (asynchronous) work is counted in the phase that queued 
+    it, rather than wherever the host next waits for it; this makes 
+    profiled runs somewhat slower. With record=True, the phases are also 
+    marked (record_function) in torch.profiler traces.
+    """
+    def __init__(self, enabled, record=False):
+        self.enabled = enabled or record
+        self.record = record
+        self.sync = self.enabled and device.type == 'cuda'
+        self.totals = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def __call__(self, phase):
+        if not self.enabled:
+            yield
+            return
+        if self.sync:
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        with torch.profiler.record_function(phase) if self.record else contextlib.nullcontext():
+            yield
+            if self.sync:
+                torch.cuda.synchronize(device)
+        self.totals[phase] = self.totals.get(phase, 0.) + time.perf_counter() - start
+
+    def iterate(self, iterable, phase):
+        "Yields the items of iterable, timing the fetching of each as phase."
+        iterator = iter(iterable)
+        while True:
+            with self(phase):
+                item = next(iterator, None)
+            if item is None:
+                return
+            yield item
+
+    def summary(self):
+        total = sum(self.totals.values())
+        return '\t'.join('%s: %.3fs (%.1f%%)' % (phase, seconds, 100 * seconds / total)
+                         for phase, seconds in self.totals.items())
+
+
+def autocast():
+    "bf16 autocast for --precision=bf16; does nothing for fp32."
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16,
+                          enabled=args.precision == 'bf16')
+
+
+def run_epoch(model, data, is_train=False, trace_path=None):
     """
     One epoch of training/validation (depending on flag is_train).
+
+    Returns the perplexity, the running total of the loss after each 
+    minibatch, the mean loss at each of the seq_len time-steps, and the 
+    PhaseTimer (whose totals are empty without --profile).
+
+    The losses are accumulated on the device and only copied back (which 
+    waits for the device to catch up) when printing and at the end of the 
+    epoch, instead of after every minibatch.
+
+    With trace_path, args.trace_steps steps (after up to 10 warmup steps) 
+    are recorded with torch.profiler and saved there as a Chrome trace.
     """
     if is_train:
         model.train()
     else:
         model.eval()
-    epoch_size = ((len(data) // model.batch_size) - 1) // model.seq_len
+    epoch_size = len(data)
     start_time = time.time()
     if args.model != 'TRANSFORMER':
         hidden = model.init_hidden()
         hidden = hidden.to(device)
-    costs = 0.0
     iters = 0
-    losses = []
+    step_losses = torch.zeros(epoch_size, device=device)
+    position_costs = torch.zeros(model.seq_len, device=device)
+    micro_batch_size = args.micro_batch_size or model.batch_size
+    # the steps at which the progress is printed
+    log_every = max(epoch_size // 10, 1)
+
+    profiler = None
+    if trace_path:
+        wait = min(10, max(epoch_size - args.trace_steps - 1, 0))
+        profiler = torch.profiler.profile(
+            schedule=torch.profiler.schedule(wait=wait, warmup=1, active=args.trace_steps, repeat=1),
+            on_trace_ready=lambda p: p.export_chrome_trace(trace_path))
+        profiler.start()
+    timer = PhaseTimer(args.profile, record=profiler is not None)
 
     # LOOP THROUGH MINIBATCHES
-    for step, (x, y) in enumerate(ptb_iterator(data, model.batch_size, model.seq_len)):
-        if args.model == 'TRANSFORMER':
-            batch = Batch(torch.from_numpy(x).long().to(device))
-            model.zero_grad()
-            outputs = model.forward(batch.data, batch.mask).transpose(1,0)
-            #print ("outputs.shape", outputs.shape)
-        else:
-            inputs = torch.from_numpy(x.astype(np.int64)).transpose(0, 1).contiguous().to(device)#.cuda()
-            model.zero_grad()
+    # x and y are int64 views of shape (seq_len, batch_size), already on device
+    for step, (x, y) in enumerate(timer.iterate(data, 'data')):
+        model.zero_grad()
+        if args.model != 'TRANSFORMER':
             hidden = repackage_hidden(hidden)
-            outputs, hidden = model(inputs, hidden)
-
-        targets = torch.from_numpy(y.astype(np.int64)).transpose(0, 1).contiguous().to(device)#.cuda()
-        tt = torch.squeeze(targets.view(-1, model.batch_size * model.seq_len))
-
-        # LOSS COMPUTATION
-        # This line currently averages across all the sequences in a mini-batch 
-        # and all time-steps of the sequences.
-        # For problem 5.3, you will (instead) need to compute the average loss 
-        #at each time-step separately. 
-        loss = loss_fn(outputs.contiguous().view(-1, model.vocab_size), tt)
-        costs += loss.data.item() * model.seq_len
-        losses.append(costs)
+            hidden_new = []
+        token_losses = []
+        # MICRO-BATCHES
+        # The minibatch is run micro_batch_size sequences (columns) at a time, 
+        # each with its own backward pass, so the gradients add up in .grad 
+        # for the one optimizer step below. By default there is one micro-batch, 
+        # the whole minibatch.
+        for i in range(0, model.batch_size, micro_batch_size):
+            xs, ys = x[:, i:i + micro_batch_size], y[:, i:i + micro_batch_size]
+            with autocast():
+                with timer('forward'):
+                    if args.model == 'TRANSFORMER':
+                        # Token ids are never negative, so pad=-1 means no padding and 
+                        # the mask is just the (cached) causal mask.
+                        batch = Batch(xs.t(), pad=-1)
+                        features = model.features(batch.data, batch.mask).transpose(1,0)
+                    else:
+                        features, h = model.features(xs, hidden[:, i:i + micro_batch_size])
+                        hidden_new.append(h)
+
+                # LOSS COMPUTATION
+                # The loss we optimize averages across all the sequences in a mini-batch 
+                # and all time-steps of the sequences; the per-token losses are also 
+                # summed over the mini-batch at each time-step separately (problem 5.x).
+                # (in fp32, whatever the precision of the model)
+                with timer('loss'):
+                    micro_losses = model.output_loss(features.reshape(-1, features.size(-1)),
+                                                     ys.reshape(-1)).float()
+            if is_train:
+                with timer('backward'):
+                    # weighted so that the gradients add up to those of the mean 
+                    # loss over the whole minibatch
+                    (micro_losses.mean() * (xs.size(1) / model.batch_size)).backward()
+            token_losses.append(micro_losses.detach().view(model.seq_len, -1))
+        if args.model != 'TRANSFORMER':
+            hidden = torch.cat(hidden_new, 1)
+        token_losses = torch.cat(token_losses, 1)
+        loss = token_losses.mean()
+        step_losses[step] = loss
+        position_costs += token_losses.sum(1)
         iters += model.seq_len
         if args.debug:
             print(step, loss)
         if is_train:  # Only update parameters if training 
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25)
-            if args.optimizer == 'ADAM':
+            if world_size > 1:
+                with timer('all_reduce'):
+                    all_reduce_gradients(model)
+            with timer('clip'):
+                # (clip_grad_norm_ handles sparse gradients: their norm and 
+                # scaling are of the coalesced gradient)
+                if args.sparse_embedding:
+                    coalesce_sparse_gradients(model)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.25, foreach=True)
+            with timer('optimizer'):
                 optimizer.step()
-            else: 
-                for p in model.parameters():
-                    if p.grad is not None:
-                        p.data.add_(-lr, p.grad.data)
-            if step % (epoch_size // 10) == 10:
+            if step % log_every == 10 % log_every:
+                with timer('sync'):
+                    costs = step_losses[:step + 1].sum().item() * model.seq_len
                 print('step: '+ str(step) + '\t' \
                     + 'loss: '+ str(costs) + '\t' \
-                    + 'speed (wps):' + str(iters * model.batch_size / (time.time() - start_time)))
-    return np.exp(costs / iters), losses
+                    + 'speed (wps):' + str(iters * model.batch_size * world_size / (time.time() - start_time)))
+        if profiler is not None:
+            profiler.step()
+    if profiler is not None:
+        profiler.stop()
+    with timer('sync'):
+        if world_size > 1:
+            # average over the processes (whose minibatches are the same size)
+            dist.all_reduce(step_losses)
+            step_losses /= world_size
+            dist.all_reduce(position_costs)
+        losses = (step_losses.double().cumsum(0) * model.seq_len).tolist()
+        costs = losses[-1]
+        position_losses = (position_costs / (epoch_size * model.batch_size * world_size)).cpu().numpy()
+    print('epoch speed (wps): ' + str(iters * model.batch_size * world_size / (time.time() - start_time)))
+    return np.exp(costs / iters), losses, position_losses, timer
 
 
 
@@ -430,8 +766,38 @@ train_ppls = []
 train_losses = []
 val_ppls = []
 val_losses = []
+val_position_losses = []
 best_val_so_far = np.inf
 times = []
+start_epoch = 0
+
+# RESUME
+# The checkpoint has everything needed to carry on as if the run had not 
+# been interrupted (up to the end of the last checkpointed epoch).
+checkpoint_path = os.path.join(args.save_dir, 'checkpoint.pt')
+if args.resume:
+    t0 = time.time()
+    checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=False)
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    if scheduler is not None:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    curves = checkpoint['curves']
+    train_ppls, val_ppls = curves['train_ppls'], curves['val_ppls']
+    train_losses, val_losses = curves['train_losses'], curves['val_losses']
+    val_position_losses, times = curves['val_position_losses'], curves['times']
+    best_val_so_far = checkpoint['best_val_so_far']
+    start_epoch = checkpoint['epoch'] + 1
+    if world_size == 1:
+        set_rng_state(checkpoint['rng'])
+    else:
+        # (the checkpoint only has rank 0's generators)
+        torch.manual_seed(args.seed + rank + world_size * start_epoch)
+    print('Resumed at epoch %d from %s in %.1f s' % (start_epoch, checkpoint_path, time.time() - t0))
+    del checkpoint
+
+# Only rank 0 writes, when distributed.
+writer = CheckpointWriter()
 
 # In debug mode, only run one epoch
 if args.debug:
@@ -440,26 +806,30 @@ else:
     num_epochs = args.num_epochs
 
 # MAIN LOOP
-for epoch in range(num_epochs):
+for epoch in range(start_epoch, num_epochs):
     t0 = time.time()
     print('\nEPOCH '+str(epoch)+' ------------------')
-    if args.optimizer == 'SGD_LR_SCHEDULE':
-        lr_decay = lr_decay_base ** max(epoch - m_flat_lr, 0)
-        lr = lr * lr_decay # decay lr if it is time
 
     # RUN MODEL ON TRAINING DATA
-    train_ppl, train_loss = run_epoch(model, train_data, True, lr)
+    trace_path = None
+    if args.trace_steps > 0 and epoch == start_epoch and rank == 0:
+        trace_path = os.path.join(args.save_dir, 'trace.json')
+    train_ppl, train_loss, _, train_timer = run_epoch(model, train_batches, True, trace_path)
+    if scheduler is not None:
+        scheduler.step() # decay lr if it is time
 
     # RUN MODEL ON VALIDATION DATA
-    val_ppl, val_loss = run_epoch(model, valid_data)
+    val_ppl, val_loss, val_position_loss, val_timer = run_epoch(model, valid_batches)
 
 
     # SAVE MODEL IF IT'S THE BEST SO FAR
+    # (written, with the checkpoint below, in the background)
+    to_save = {}
     if val_ppl < best_val_so_far:
         best_val_so_far = val_ppl
-        if args.save_best:
+        if args.save_best and rank == 0:
             print("Saving model parameters to best_params.pt")
-            torch.save(model.state_dict(), os.path.join(args.save_dir, 'best_params.pt'))
+            to_save[os.path.join(args.save_dir, 'best_params.pt')] = model.state_dict()
         # NOTE ==============================================
         # You will need to load these parameters into the same model
         # for a couple Problems: so that you can compute the gradient 
@@ -474,6 +844,7 @@ for epoch in range(num_epochs):
     val_ppls.append(val_ppl)
     train_losses.extend(train_loss)
     val_losses.extend(val_loss)
+    val_position_losses.append(val_position_loss)
     times.append(time.time() - t0)
     log_str = 'epoch: ' + str(epoch) + '\t' \
             + 'train ppl: ' + str(train_ppl) + '\t' \
@@ -481,16 +852,47 @@ for epoch in range(num_epochs):
             + 'best val: ' + str(best_val_so_far) + '\t' \
             + 'time (s) spent in epoch: ' + str(times[-1])
     print(log_str)
-    with open (os.path.join(args.save_dir, 'log.txt'), 'a') as f_:
-        f_.write(log_str+ '\n')
+    if rank == 0:
+        with open (os.path.join(args.save_dir, 'log.txt'), 'a') as f_:
+            f_.write(log_str+ '\n')
+    if args.profile:
+        # where the time of the epoch went (on rank 0, when distributed)
+        profile_str = ''.join('profile: epoch %d\t%s\t%s\n' % (epoch, name, timer.summary())
+                              for name, timer in (('train', train_timer), ('valid', val_timer)))
+        print(profile_str, end='')
+        if rank == 0:
+            with open (os.path.join(args.save_dir, 'profile.txt'), 'a') as f_:
+                f_.write(profile_str)
+
+    # SAVE A CHECKPOINT
+    if rank == 0 and args.save_every > 0 and ((epoch + 1) % args.save_every == 0 
+                                               or epoch + 1 == num_epochs):
+        to_save[checkpoint_path] = {
+            'epoch': epoch,
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict() if scheduler is not None else None,
+            'rng': rng_state(),
+            'best_val_so_far': best_val_so_far,
+            'curves': {'train_ppls': train_ppls, 'val_ppls': val_ppls,
+                       'train_losses': train_losses, 'val_losses': val_losses,
+                       'val_position_losses': val_position_losses, 'times': times},
+            'args': argsdict}
+    if to_save:
+        writer.save(to_save)
+writer.wait()
 
 # SAVE LEARNING CURVES
-lc_path = os.path.join(args.save_dir, 'learning_curves.npy')
-print('\nDONE\n\nSaving learning curves to '+lc_path)
-np.save(lc_path, {'train_ppls':train_ppls, 
-                  'val_ppls':val_ppls, 
-                  'train_losses':train_losses,
-                  'val_losses':val_losses})
+if rank == 0:
+    lc_path = os.path.join(args.save_dir, 'learning_curves.npy')
+    print('\nDONE\n\nSaving learning curves to '+lc_path)
+    np.save(lc_path, {'train_ppls':train_ppls, 
+                      'val_ppls':val_ppls, 
+                      'train_losses':train_losses,
+                      'val_losses':val_losses,
+                      'val_position_losses':val_position_losses})
+if args.distributed:
+    dist.destroy_process_group()
 # NOTE ==============================================
 # To load these, run 
 # >>> x = np.load(lc_path)[()]
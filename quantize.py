@@ -0,0 +1,128 @@
+#!/bin/python
+# coding: utf-8
+
+# Post-training int8 quantization of a saved RNN, GRU or Transformer language
+# model, for inference on the cpu (see models.quantize_model). For example:
+#    python quantize.py --model=GRU --hidden_size=1500 --num_layers=2 \
+#        --load=GRU_SGD_LR_SCHEDULE_..._0/best_params.pt --quantization=dynamic
+#
+# The model flags must match the ones the model was trained with. Static
+# quantization calibrates on the first --calibration_batches minibatches of
+# the validation data.
+#
+# The quantized model is saved whole (--out, by default quantized_<quantization>.pt
+# next to --load), since its quantized layers are not those of the fp32
+# model; load it (with models.py importable) with
+#    model = torch.load(path, weights_only=False)
+# and run it as usual, in eval mode and on the cpu.
+#
+# Reports the validation perplexity, the inference latency (per minibatch of
+# --batch_size x --seq_len) and the size of the fp32 and int8 models.
+
+import argparse
+import io
+import itertools
+import os
+import time
+import torch
+
+import models
+from benchmark import forward, perplexity
+from reader import ptb_raw_data, ptb_iterator, TensorBatches
+
+
+parser = argparse.ArgumentParser(description='int8 quantization of the PTB language models')
+parser.add_argument('--data', type=str, default='data',
+                    help='location of the data corpus (for calibration and the perplexity)')
+parser.add_argument('--model', type=str, default='RNN',
+                    help='type of net (RNN, GRU, TRANSFORMER)')
+parser.add_argument('--load', type=str, default='',
+                    help='saved parameters (e.g. best_params.pt) to quantize')
+parser.add_argument('--hidden_size', type=int, default=200)
+parser.add_argument('--num_layers', type=int, default=2)
+parser.add_argument('--emb_size', type=int, default=200)
+parser.add_argument('--softmax', type=str, default='full',
+                    help='output layer the model was trained with (full, adaptive, sampled)')
+parser.add_argument('--adaptive_cutoffs', type=str, default='2000,6000')
+parser.add_argument('--attention_backend', type=str, default='reference')
+parser.add_argument('--quantization', type=str, default='dynamic',
+                    help='dynamic (int8 weights, activations quantized on the fly) \
+                    or static (activation ranges calibrated up front)')
+parser.add_argument('--calibration_batches', type=int, default=20,
+                    help='number of validation minibatches to calibrate static quantization on')
+parser.add_argument('--out', type=str, default='',
+                    help='file to save the quantized model to')
+parser.add_argument('--batch_size', type=int, default=20)
+parser.add_argument('--seq_len', type=int, default=35)
+parser.add_argument('--num_threads', type=int, default=None,
+                    help='number of cpu threads torch may use (default: torch decides)')
+parser.add_argument('--warmup', type=int, default=3,
+                    help='number of untimed forward passes')
+parser.add_argument('--iters', type=int, default=20,
+                    help='number of timed forward passes')
+parser.add_argument('--seed', type=int, default=1111)
+
+
+def latency(model, args, inputs):
+    """ Mean time in seconds of a forward pass (eval mode, no gradients) on inputs. """
+    model.eval()
+    if args.model != 'TRANSFORMER':
+        model.batch_size = inputs.size(1)
+    with torch.no_grad():
+        for _ in range(args.warmup):
+            forward(model, args, inputs)
+        start_time = time.time()
+        for _ in range(args.iters):
+            forward(model, args, inputs)
+    return (time.time() - start_time) / args.iters
+
+
+def serialized_size(obj):
+    """ Size in bytes of obj saved with torch.save. """
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    return buffer.getbuffer().nbytes
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    _, valid_data, _, word_to_id, _ = ptb_raw_data(data_path=args.data)
+    args.vocab_size = len(word_to_id)
+    model = models.build_model(args.model, args.vocab_size, emb_size=args.emb_size,
+                               hidden_size=args.hidden_size, seq_len=args.seq_len,
+                               batch_size=args.batch_size, num_layers=args.num_layers,
+                               attention_backend=args.attention_backend, softmax=args.softmax,
+                               adaptive_cutoffs=[int(c) for c in args.adaptive_cutoffs.split(',')])
+    if args.load:
+        model.load_state_dict(torch.load(args.load, map_location='cpu'))
+    model.eval()
+
+    calibration = [torch.from_numpy(x.T.astype('int64')) for x, _ in itertools.islice(
+        ptb_iterator(valid_data, args.batch_size, args.seq_len), args.calibration_batches)]
+    quantized = models.quantize_model(model, args.quantization, calibration)
+
+    if not args.out:
+        args.out = os.path.join(os.path.dirname(args.load) if args.load else '.',
+                                'quantized_%s.pt' % args.quantization)
+    torch.save(quantized, args.out)
+    print('Saved the %s int8 model to %s' % (args.quantization, args.out))
+    # (measured on the saved model, as it will be used)
+    quantized = torch.load(args.out, weights_only=False)
+
+    valid_batches = TensorBatches(valid_data, args.batch_size, args.seq_len)
+    inputs = torch.randint(args.vocab_size, (args.seq_len, args.batch_size))
+    results = {}
+    for name, m in (('fp32', model), ('int8', quantized)):
+        ppl = perplexity(m, args, valid_batches, 'fp32')
+        seconds = latency(m, args, inputs)
+        size = serialized_size(m.state_dict()) if m is model else os.path.getsize(args.out)
+        results[name] = (ppl, seconds, size)
+        print('  %-4s  val ppl %9.3f   %8.2f ms/batch   %8.1f MB' % (
+            name, ppl, 1000 * seconds, size / 2**20))
+    (ppl, seconds, size), (q_ppl, q_seconds, q_size) = results['fp32'], results['int8']
+    print('  int8: val ppl %+.2f%%, %.2fx faster, %.2fx smaller' % (
+        100 * (q_ppl / ppl - 1), seconds / q_seconds, size / q_size))
@@ -0,0 +1,381 @@
+# coding: utf-8
+
+# Reading and batching of the Penn Treebank data for ptb-lm.py (and any other
+# script that needs the same data).
+#
+# based on code from:
+#    https://github.com/deeplearningathome/pytorch-language-model/blob/master/reader.py
+
+import collections
+import hashlib
+import multiprocessing
+import os
+import shutil
+import numpy
+np = numpy
+import torch
+
+# Bump this whenever the way the cache is built or laid out changes, so stale
+# caches are not picked up.
+CACHE_VERSION = 1
+SPLITS = ("train", "valid", "test")
+
+
+# HELPER FUNCTIONS
+def _read_words(filename):
+    with open(filename, "r") as f:
+      return f.read().replace("\n", "<eos>").split()
+
+def _build_vocab(filename):
+    data = _read_words(filename)
+    return _vocab_from_counts(collections.Counter(data))
+
+def _vocab_from_counts(counter):
+    count_pairs = sorted(counter.items(), key=lambda x: (-x[1], x[0]))
+
+    words, _ = list(zip(*count_pairs))
+    word_to_id = dict(zip(words, range(len(words))))
+    id_to_word = dict((v, k) for k, v in word_to_id.items())
+
+    return word_to_id, id_to_word
+
+def _file_to_word_ids(filename, word_to_id):
+    data = _read_words(filename)
+    return [word_to_id[word] for word in data if word in word_to_id]
+
+
+# TOKEN-ID CACHE
+# The vocabulary and the token ids of each split are saved once under
+# <data_path>/.cache/<key>/ (vocab.txt, plus train.npy, valid.npy and test.npy
+# as int32 arrays), where the key is a hash of the contents of the text files.
+# Later runs memory-map the arrays instead of re-tokenizing the text.
+def _file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _cache_dir(data_path, paths):
+    h = hashlib.sha1(str(CACHE_VERSION).encode())
+    for path in paths:
+        h.update(_file_hash(path).encode())
+    return os.path.join(data_path, ".cache", h.hexdigest())
+
+def _load_cache(cache_dir):
+    with open(os.path.join(cache_dir, "vocab.txt"), "r") as f:
+        words = f.read().split("\n")
+    word_to_id = dict(zip(words, range(len(words))))
+    id_to_word = dict(enumerate(words))
+    splits = [np.load(os.path.join(cache_dir, split + ".npy"), mmap_mode="r")
+              for split in SPLITS]
+    return tuple(splits) + (word_to_id, id_to_word)
+
+def _build_cache(cache_dir, paths, workers, chunk_bytes):
+    """
+    Tokenizes the text files (train, valid, test) into the cache, streaming: 
+    the files are read in chunks of about chunk_bytes, by a pool of workers, 
+    and the token ids are written straight into the memory-mapped .npy 
+    files, so neither the text nor the ids are ever all in memory. Three 
+    passes: the train chunks' word counts (merged into the vocabulary), the 
+    number of in-vocabulary tokens of each valid and test chunk (for where 
+    its ids go), and the ids.
+    """
+    # Written to a temporary directory and renamed into place, so that a
+    # crashed or concurrent run never leaves a half-written cache behind.
+    tmp_dir = cache_dir + ".tmp" + str(os.getpid())
+    os.makedirs(tmp_dir)
+    try:
+        train_chunks = _chunks(paths[0], chunk_bytes)
+        counter = collections.Counter()
+        train_sizes = []
+        for counts in _map(_count_words, train_chunks, workers):
+            counter.update(counts)
+            train_sizes.append(sum(counts.values()))
+        word_to_id, _ = _vocab_from_counts(counter)
+        del counter
+        with open(os.path.join(tmp_dir, "vocab.txt"), "w") as f:
+            f.write("\n".join(sorted(word_to_id, key=word_to_id.get)))
+
+        for split, path in zip(SPLITS, paths):
+            if split == "train":
+                chunks, sizes = train_chunks, train_sizes  # every train word is in the vocabulary
+            else:
+                chunks = _chunks(path, chunk_bytes)
+                sizes = list(_map(_count_known_words, chunks, workers, word_to_id))
+            offsets = np.cumsum([0] + sizes)
+            out_path = os.path.join(tmp_dir, split + ".npy")
+            if offsets[-1] == 0:
+                np.save(out_path, np.zeros(0, dtype=np.int32))
+                continue
+            out = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.int32, shape=(int(offsets[-1]),))
+            del out  # (just allocates the file; the workers fill it in)
+            tasks = [chunk + (out_path, int(offset)) for chunk, offset in zip(chunks, offsets)]
+            for _ in _map(_write_ids, tasks, workers, word_to_id):
+                pass
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isdir(cache_dir):  # i.e. not just beaten to it by another run
+            raise
+    except BaseException:
+        # (e.g. a worker's error, a decode error, or KeyboardInterrupt)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+# STREAMING TOKENIZATION
+# A file is split into chunks (byte ranges) that each end just after a 
+# space, so that no token spans two chunks, and tokenizing the chunks one 
+# by one gives the same tokens as _read_words (which also glues "<eos>" to 
+# a word at the start or end of a line, when there is no space in between).
+def _chunks(filename, chunk_bytes):
+    size = os.path.getsize(filename)
+    chunks = []
+    with open(filename, "rb") as f:
+        start = 0
+        while start < size:
+            end = min(start + chunk_bytes, size)
+            f.seek(end)
+            while end < size:
+                block = f.read(1 << 16)
+                i = block.find(b" ")
+                if i >= 0:
+                    end += i + 1
+                    break
+                end += len(block)
+            chunks.append((filename, start, min(end, size)))
+            start = end
+    return chunks
+
+def _chunk_words(filename, start, end):
+    with open(filename, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+    # (newlines as in a file opened in text mode)
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text.replace("\n", "<eos>").split()
+
+# The workers' tasks; the vocabulary (word_to_id) is given to each worker 
+# once, when the pool starts.
+_worker_vocab = None
+
+def _init_worker(word_to_id):
+    global _worker_vocab
+    _worker_vocab = word_to_id
+
+def _count_words(chunk):
+    return collections.Counter(_chunk_words(*chunk))
+
+def _count_known_words(chunk):
+    return sum(1 for word in _chunk_words(*chunk) if word in _worker_vocab)
+
+def _write_ids(task):
+    filename, start, end, out_path, offset = task
+    ids = np.array([_worker_vocab[word] for word in _chunk_words(filename, start, end)
+                    if word in _worker_vocab], dtype=np.int32)
+    out = np.load(out_path, mmap_mode="r+")
+    out[offset:offset + len(ids)] = ids
+    out.flush()
+    del out
+
+def _map(function, tasks, workers, word_to_id=None):
+    """
+    Yields function(task) for each of tasks, in order, computed by a pool 
+    of workers processes (or here, if there is only one task or worker).
+    The pool forks, so that the workers do not re-run the calling script 
+    (e.g. ptb-lm.py, which has no __main__ guard); where there is no fork, 
+    everything is done here.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(tasks))
+    if workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        _init_worker(word_to_id)
+        for task in tasks:
+            yield function(task)
+        return
+    context = multiprocessing.get_context("fork")
+    with context.Pool(workers, _init_worker, (word_to_id,)) as pool:
+        for result in pool.imap(function, tasks):
+            yield result
+
+
+# Processes the raw data from text files
+def ptb_raw_data(data_path=None, prefix="ptb", cache=True, workers=None, chunk_bytes=1 << 23):
+    """
+    Returns the token ids of the train, valid and test splits (as int32 numpy
+    arrays, memory-mapped when they come from the cache) and the word_to_id
+    and id_to_word dicts.
+
+    The first time, the cache is built by streaming the text through 
+    workers processes (default: one per cpu) in chunks of chunk_bytes (see 
+    _build_cache), so corpora much larger than memory can be used. With 
+    cache=False the text is always re-tokenized, in memory, and nothing is 
+    written.
+    """
+    train_path = os.path.join(data_path, prefix + ".train.txt")
+    valid_path = os.path.join(data_path, prefix + ".valid.txt")
+    test_path = os.path.join(data_path, prefix + ".test.txt")
+
+    if cache:
+        cache_dir = _cache_dir(data_path, [train_path, valid_path, test_path])
+        if os.path.isdir(cache_dir):
+            return _load_cache(cache_dir)
+        try:
+            _build_cache(cache_dir, [train_path, valid_path, test_path], workers, chunk_bytes)
+            return _load_cache(cache_dir)
+        except OSError as e:
+            print("WARNING: could not write the data cache to %s: %s" % (cache_dir, e))
+
+    word_to_id, id_2_word = _build_vocab(train_path)
+    train_data = np.array(_file_to_word_ids(train_path, word_to_id), dtype=np.int32)
+    valid_data = np.array(_file_to_word_ids(valid_path, word_to_id), dtype=np.int32)
+    test_data = np.array(_file_to_word_ids(test_path, word_to_id), dtype=np.int32)
+    return train_data, valid_data, test_data, word_to_id, id_2_word
+
+def _shard(batch_size, rank, world_size):
+    """
+    The rows (i.e. the columns of the time-major minibatches) of a 
+    (batch_size, batch_len) layout of the corpus that belong to process rank 
+    of world_size, in distributed training: a contiguous block of 
+    batch_size // world_size of them.
+    """
+    if batch_size % world_size != 0:
+        raise ValueError("batch_size (%d) must be a multiple of the number of processes (%d)"
+                         % (batch_size, world_size))
+    local_batch_size = batch_size // world_size
+    return slice(rank * local_batch_size, (rank + 1) * local_batch_size)
+
+# Yields minibatches of data
+# With world_size > 1, batch_size is the total over all processes, and only 
+# the batch_size // world_size sequences of this rank are yielded.
+def ptb_iterator(raw_data, batch_size, num_steps, rank=0, world_size=1):
+    # No copy when raw_data is already an int32 array (e.g. from the cache).
+    raw_data = np.asarray(raw_data, dtype=np.int32)
+
+    data_len = len(raw_data)
+    batch_len = data_len // batch_size
+    data = raw_data[:batch_size * batch_len].reshape(batch_size, batch_len)
+    data = data[_shard(batch_size, rank, world_size)]
+
+    epoch_size = (batch_len - 1) // num_steps
+
+    if epoch_size == 0:
+        raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
+
+    for i in range(epoch_size):
+        x = data[:, i*num_steps:(i+1)*num_steps]
+        y = data[:, i*num_steps+1:(i+1)*num_steps+1]
+        yield (x, y)
+
+
+class TensorBatches:
+    """
+    The same minibatches as ptb_iterator, as int64 torch tensors already laid 
+    out the way the models take them: (num_steps, batch_size).
+
+    On a GPU, by default, the corpus is converted and reshaped once, here, 
+    into a time-major (batch_len, batch_size) tensor on the device, so every 
+    minibatch is a view of it and iterating (any number of epochs) allocates 
+    and copies nothing.
+
+    Otherwise, i.e. on the cpu or with prefetch=True, the corpus is never 
+    loaded as a whole: it stays the int32 array it was given (memory-mapped, 
+    when it comes from the cache, so processes reading the same corpus share 
+    it through the page cache), and each minibatch is sliced out of it and 
+    converted as it is used, into a reused buffer (so a minibatch is only 
+    valid until the next one is asked for). With prefetch=True each one is 
+    then copied to the device on a side stream, from one of two reused 
+    pinned buffers, while the previous one is being used, for corpora too 
+    big to keep on the device.
+
+    For distributed training, rank and world_size select this process's 
+    share of the sequences, as in ptb_iterator; batch_size is then the total 
+    and self.batch_size this process's.
+    """
+    def __init__(self, raw_data, batch_size, num_steps, device=None, prefetch=False,
+                 rank=0, world_size=1):
+        raw_data = np.asarray(raw_data)
+        shard = _shard(batch_size, rank, world_size)
+        self.batch_size = shard.stop - shard.start
+        self.num_steps = num_steps
+        self.device = torch.device(device) if device is not None else torch.device("cpu")
+        self.prefetch = prefetch and self.device.type == "cuda"
+
+        batch_len = len(raw_data) // batch_size
+        self.epoch_size = (batch_len - 1) // num_steps
+        if self.epoch_size == 0:
+            raise ValueError("epoch_size == 0, decrease batch_size or num_steps")
+
+        # (a view: nothing is read yet)
+        data = raw_data[:batch_size * batch_len].reshape(batch_size, batch_len)[shard]
+        self.resident = self.device.type != "cpu" and not self.prefetch
+        if self.resident:
+            # Moved as int32 and widened on the device, so the host only ever 
+            # holds one int32 copy of the split.
+            data = torch.from_numpy(np.array(data, dtype=np.int32)).to(self.device)
+            self.data = data.t().contiguous().long()
+        else:
+            self.data = data
+
+    def __len__(self):
+        return self.epoch_size
+
+    def __iter__(self):
+        if self.prefetch:
+            return self._prefetch_iter()
+        if self.resident:
+            return self._resident_iter()
+        return self._host_iter()
+
+    def _rows(self, i):
+        # The inputs and targets of minibatch i are rows [i*n, (i+1)*n] 
+        # offset by one, so they are two views of one (num_steps+1)-row slice.
+        return slice(i * self.num_steps, (i + 1) * self.num_steps + 1)
+
+    def _fill(self, window, i):
+        # (widened to int64 straight into window's memory)
+        np.copyto(window.numpy(), self.data[:, self._rows(i)].T, casting="unsafe")
+
+    def _resident_iter(self):
+        for i in range(self.epoch_size):
+            window = self.data[self._rows(i)]
+            yield window[:-1], window[1:]
+
+    def _host_iter(self):
+        # One window, refilled for every minibatch: a minibatch is only valid 
+        # until the next one is asked for.
+        window = torch.empty(self.num_steps + 1, self.batch_size, dtype=torch.long)
+        for i in range(self.epoch_size):
+            self._fill(window, i)
+            yield window[:-1], window[1:]
+
+    def _prefetch_iter(self):
+        stream = torch.cuda.Stream(self.device)
+        # Two pinned host windows, used in turn: one is filled while the 
+        # other's copy to the device may still be in flight. Before a window 
+        # is refilled, its last copy is waited for.
+        slots = [torch.empty(self.num_steps + 1, self.batch_size, dtype=torch.long).pin_memory()
+                 for _ in range(2)]
+        copied = [None, None]
+        def fetch(i):
+            slot = i % 2
+            if copied[slot] is not None:
+                copied[slot].synchronize()
+            self._fill(slots[slot], i)
+            with torch.cuda.stream(stream):
+                window = slots[slot].to(self.device, non_blocking=True)
+            copied[slot] = stream.record_event()
+            return window
+
+        next_window = fetch(0)
+        for i in range(self.epoch_size):
+            window = next_window
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            # window was allocated on the side stream but is used on this one
+            window.record_stream(current)
+            if i + 1 < self.epoch_size:
+                next_window = fetch(i + 1)
+            yield window[:-1], window[1:]
@@ -0,0 +1,311 @@
+#!/bin/python
+# coding: utf-8
+
+# Serves a (saved) RNN, GRU or Transformer language model over HTTP, for
+# scoring and sampling text. The model is loaded once; concurrent requests
+# are batched together (up to --max_batch_size of them, waiting at most
+# --max_wait_ms for the batch to fill up) and run under torch.inference_mode.
+#
+# The model flags must match the ones the model was trained with, e.g.
+#    python serve.py --model=GRU --hidden_size=1500 --num_layers=2 \
+#        --load=GRU_SGD_LR_SCHEDULE_..._0/best_params.pt --port=8000
+#
+# POST /score     {"text": "the company said"}
+#   -> {"words": [...], "log_probs": [...], "log_prob": ..., "perplexity": ...}
+#      the log-probability of every word (the first one given <eos>, i.e. as
+#      the start of a sentence); words not in the vocabulary are <unk>
+# POST /generate  {"prompt": "the company", "length": 20, "temperature": 1.0,
+#                  "top_k": 0, "top_p": 1.0, "stop_at_eos": false}
+#   -> {"words": [...], "text": "..."}, the sampled continuation
+#
+# With --benchmark, it instead starts the server in the background, sends it
+# --bench_requests scoring requests (validation sentences) from
+# --bench_concurrency client threads, and reports the latency percentiles
+# and the requests per second, e.g.
+#    python serve.py --model=GRU --hidden_size=1500 --benchmark --max_batch_size=1
+#    python serve.py --model=GRU --hidden_size=1500 --benchmark --max_batch_size=32
+
+import argparse
+import json
+import math
+import queue
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+import models
+from models import subsequent_mask
+from reader import ptb_raw_data
+
+
+parser = argparse.ArgumentParser(description='Serve the PTB language models over HTTP')
+parser.add_argument('--data', type=str, default='data',
+                    help='location of the data corpus (for the vocabulary)')
+parser.add_argument('--model', type=str, default='RNN',
+                    help='type of net (RNN, GRU, TRANSFORMER)')
+parser.add_argument('--load', type=str, default='',
+                    help='saved parameters (e.g. best_params.pt) to serve; without \
+                    it the model is randomly initialized (for timing only)')
+parser.add_argument('--hidden_size', type=int, default=200)
+parser.add_argument('--num_layers', type=int, default=2)
+parser.add_argument('--emb_size', type=int, default=200)
+parser.add_argument('--softmax', type=str, default='full',
+                    help='output layer the model was trained with (full, adaptive, sampled)')
+parser.add_argument('--adaptive_cutoffs', type=str, default='2000,6000')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--max_batch_size', type=int, default=32,
+                    help='largest number of requests run together')
+parser.add_argument('--max_wait_ms', type=float, default=5.,
+                    help='longest a request waits for others to batch it with')
+parser.add_argument('--max_words', type=int, default=1000,
+                    help='longest text (or prompt plus length) accepted')
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--benchmark', action='store_true',
+                    help='run the load-generation benchmark instead of serving')
+parser.add_argument('--bench_requests', type=int, default=500)
+parser.add_argument('--bench_concurrency', type=int, default=16)
+parser.add_argument('--seed', type=int, default=1111)
+
+
+class Batcher:
+    """
+    Runs the model for the request handlers, from a single thread: requests
+    are queued, and each batch is whatever is queued when the first of it
+    arrives, plus whatever arrives in the next max_wait_ms, up to
+    max_batch_size requests. Scoring requests are run together, and so are
+    generation requests with the same sampling options.
+    """
+    def __init__(self, model, args, word_to_id, id_2_word):
+        self.model = model
+        self.args = args
+        self.word_to_id = word_to_id
+        self.id_2_word = id_2_word
+        self.eos = word_to_id['<eos>']
+        self.unk = word_to_id['<unk>']
+        self.device = torch.device(args.device)
+        self.queue = queue.Queue()
+        self.batch_sizes = []
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, kind, request):
+        """
+        Runs request (a dict, as posted) and returns its result; called by 
+        the handlers. Bad requests raise ValueError here, before being queued, 
+        so they never fail the batch they would have been in.
+        """
+        item = {'kind': kind, 'request': request, 'done': threading.Event()}
+        if kind == 'score':
+            item['key'] = ('score',)
+            item['tokens'] = self.encode(request['text'])
+        else:
+            # the sampling options, which must be the same for the whole batch
+            item['key'] = ('generate', float(request.get('temperature', 1.)),
+                           int(request.get('top_k', 0)), float(request.get('top_p', 1.)),
+                           bool(request.get('stop_at_eos', False)))
+            item['tokens'] = self.encode(request.get('prompt', ''))
+            item['length'] = int(request.get('length', 20))
+            if not 0 < item['length'] <= self.args.max_words + 1 - len(item['tokens']):
+                raise ValueError('length must be positive, and prompt plus length at most %d words'
+                                 % self.args.max_words)
+        self.queue.put(item)
+        item['done'].wait()
+        if 'error' in item:
+            raise item['error']
+        return item['result']
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.args.max_wait_ms / 1000
+            while len(batch) < self.args.max_batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            self.batch_sizes.append(len(batch))
+            groups = {}
+            for item in batch:
+                groups.setdefault(item['key'], []).append(item)
+            for key, items in groups.items():
+                try:
+                    with torch.inference_mode():
+                        if key[0] == 'score':
+                            results = self.score(items)
+                        else:
+                            results = self.generate(items, *key[1:])
+                    for item, result in zip(items, results):
+                        item['result'] = result
+                except Exception as e:
+                    for item in items:
+                        item['error'] = e
+                for item in items:
+                    item['done'].set()
+
+    def encode(self, text):
+        "The ids of the words of text, after an <eos> (the start of a sentence)."
+        if not isinstance(text, str):
+            raise ValueError('the text and prompt must be strings')
+        words = text.lower().split()
+        if len(words) > self.args.max_words:
+            raise ValueError('more than %d words' % self.args.max_words)
+        return [self.eos] + [self.word_to_id.get(w, self.unk) for w in words]
+
+    def pad(self, sequences, left=False):
+        """ The sequences in a (batch, length) tensor, padded with <eos> to the right (or left). """
+        length = max(len(s) for s in sequences)
+        x = torch.full((len(sequences), length), self.eos, dtype=torch.long)
+        for i, s in enumerate(sequences):
+            if left:
+                x[i, length - len(s):] = torch.tensor(s)
+            else:
+                x[i, :len(s)] = torch.tensor(s)
+        return x.to(self.device)
+
+    def score(self, items):
+        sequences = [item['tokens'] for item in items]
+        x = self.pad(sequences)
+        inputs, targets = x[:, :-1], x[:, 1:]
+        # (the models are causal, so the padding on the right changes nothing before it)
+        if self.args.model == 'TRANSFORMER':
+            features = self.model.features(inputs, subsequent_mask(inputs.size(1), self.device))
+        else:
+            self.model.batch_size = len(items)
+            features, _ = self.model.features(inputs.t(), self.model.init_hidden())
+            features = features.transpose(0, 1)
+        log_probs = -self.model.output_loss(features.reshape(-1, features.size(-1)),
+                                            targets.reshape(-1)).float().view(len(items), -1)
+        results = []
+        for s, lp in zip(sequences, log_probs.cpu().numpy()):
+            lp = lp[:len(s) - 1]
+            results.append({'words': [self.id_2_word[i] for i in s[1:]],
+                            'log_probs': lp.tolist(), 'log_prob': float(lp.sum()),
+                            'perplexity': math.exp(-lp.mean()) if len(lp) else None})
+        return results
+
+    def generate(self, items, temperature, top_k, top_p, stop_at_eos):
+        prompts = [item['tokens'] for item in items]
+        lengths = [item['length'] for item in items]
+        # Padded on the left with <eos>, i.e. as if after an empty sentence, so
+        # that every prompt ends at the same position.
+        x = self.pad(prompts, left=True)
+        eos = self.eos if stop_at_eos else None
+        if self.args.model == 'TRANSFORMER':
+            samples = self.model.generate(x, max(lengths), temperature, top_k, top_p, eos)
+        else:
+            self.model.batch_size = len(items)
+            hidden = self.model.init_hidden()
+            if x.size(1) > 1:
+                _, hidden = self.model(x[:, :-1].t(), hidden)
+            samples = self.model.generate(x[:, -1], hidden, max(lengths), temperature, top_k, top_p, eos)
+        results = []
+        for i, length in enumerate(lengths):
+            words = [self.id_2_word[int(w)] for w in samples[:length, i]]
+            if stop_at_eos and '<eos>' in words:
+                words = words[:words.index('<eos>')]
+            results.append({'words': words, 'text': ' '.join(words)})
+        return results
+
+
+class Server(ThreadingHTTPServer):
+    # The default backlog of 5 connections makes bursts of clients wait for 
+    # TCP retransmits (a second or more).
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_handler(batcher):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            kind = self.path.strip('/')
+            try:
+                if kind not in ('score', 'generate'):
+                    return self.respond(404, {'error': 'unknown endpoint %s' % self.path})
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                self.respond(200, batcher.submit(kind, request))
+            except (ValueError, TypeError, KeyError) as e:
+                self.respond(400, {'error': str(e)})
+            except Exception as e:
+                self.respond(500, {'error': repr(e)})
+
+        def respond(self, status, body):
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # no line per request
+    return Handler
+
+
+def benchmark(server, batcher, sentences, args):
+    """
+    Sends args.bench_requests scoring requests from args.bench_concurrency
+    threads, each waiting for its response before sending the next; prints
+    the latencies and throughput.
+    """
+    url = 'http://%s:%d/score' % server.server_address[:2]
+    latencies = []
+    def client(n):
+        for i in range(n):
+            body = json.dumps({'text': sentences[np.random.randint(len(sentences))]}).encode()
+            start = time.time()
+            urllib.request.urlopen(urllib.request.Request(url, body)).read()
+            latencies.append(time.time() - start)
+
+    per_client = args.bench_requests // args.bench_concurrency
+    client(min(per_client, 5))  # warmup
+    del latencies[:], batcher.batch_sizes[:]
+    threads = [threading.Thread(target=client, args=(per_client,)) for _ in range(args.bench_concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    ms = 1000 * np.array(latencies)
+    print('%d requests from %d clients, max_batch_size=%d max_wait_ms=%g:' % (
+        len(latencies), args.bench_concurrency, args.max_batch_size, args.max_wait_ms))
+    print('  %8.1f requests/s   latency p50 %7.1f ms  p99 %7.1f ms   mean batch %.1f' % (
+        len(latencies) / seconds, np.percentile(ms, 50), np.percentile(ms, 99),
+        np.mean(batcher.batch_sizes)))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    train_data, valid_data, _, word_to_id, id_2_word = ptb_raw_data(data_path=args.data)
+    model = models.build_model(args.model, len(word_to_id), emb_size=args.emb_size,
+                               hidden_size=args.hidden_size, num_layers=args.num_layers,
+                               softmax=args.softmax,
+                               adaptive_cutoffs=[int(c) for c in args.adaptive_cutoffs.split(',')])
+    if args.model == 'TRANSFORMER':
+        # a text (or prompt plus length) is run after an <eos>, one position each
+        max_len = model.embedding[1].pe.size(1)
+        if args.max_words + 1 > max_len:
+            parser.error('--max_words must be at most %d with --model=TRANSFORMER '
+                         '(the positional encodings have %d positions)' % (max_len - 1, max_len))
+    if args.load:
+        model.load_state_dict(torch.load(args.load, map_location='cpu'))
+    model = model.to(args.device).eval()
+
+    batcher = Batcher(model, args, word_to_id, id_2_word)
+    server = Server((args.host, 0 if args.benchmark else args.port), make_handler(batcher))
+    if args.benchmark:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        words = [id_2_word[int(i)] for i in valid_data]
+        sentences = [s.strip() for s in ' '.join(words).split('<eos>') if s.strip()]
+        benchmark(server, batcher, sentences, args)
+        server.shutdown()
+    else:
+        print('Serving %s on http://%s:%d' % (args.model, args.host, args.port))
+        server.serve_forever()
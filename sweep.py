@@ -0,0 +1,221 @@
+#!/bin/python
+# coding: utf-8
+
+# Runs a hyperparameter sweep of ptb-lm.py: every run of a grid (or list) of
+# flag settings, several at a time, each in its own process, and writes a
+# table of the results. For example:
+#    python sweep.py problem_4_3.json --workers=4 --min_epochs=2 --eta=2
+#
+# The config is a JSON file with the flags shared by all runs ("base"), and
+# either a grid of values to take every combination of ("grid"), or a list
+# of runs ("runs"), or both, e.g.
+#    {"base": {"model": "GRU", "optimizer": "SGD_LR_SCHEDULE", "num_epochs": 40,
+#              "batch_size": 20, "seq_len": 35, "num_layers": 2},
+#     "grid": {"initial_lr": [1, 10], "hidden_size": [512, 1500],
+#              "dp_keep_prob": [0.35, 0.5]}}
+# A flag set to true is passed as --flag (e.g. "save_best": true), and one
+# set to false is left out.
+#
+# - The data is tokenized once, into the token-id cache (see reader.py),
+#   before any run starts; every run then memory-maps the same cached
+#   arrays. Runs on the cpu read their minibatches straight from those (see
+#   TensorBatches), so they share one copy of the corpus in memory (the OS
+#   page cache) instead of each re-tokenizing and holding its own; runs on
+#   a GPU each keep their own copy of it on the device.
+# - Each run gets --threads_per_run cpu threads (OMP_NUM_THREADS), by
+#   default the cpus divided evenly among the workers, so that the runs do
+#   not oversubscribe the cpus.
+# - With --min_epochs, losing runs are stopped early by (asynchronous)
+#   successive halving on the validation perplexity: each time a run
+#   finishes epoch min_epochs, min_epochs*eta, min_epochs*eta^2, ..., it only
+#   goes on if its val ppl is among the best 1/eta of those of all the runs
+#   that got that far so far (the first to get there always goes on).
+#
+# The runs, and their output (out.txt), go in --sweep_dir, and the results
+# (one row per run, best first) in <sweep_dir>/results.tsv.
+
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from reader import ptb_raw_data
+
+
+parser = argparse.ArgumentParser(description='Hyperparameter sweeps of ptb-lm.py')
+parser.add_argument('config', type=str,
+                    help='JSON file with the "base" flags and the "grid" and/or "runs"')
+parser.add_argument('--sweep_dir', type=str, default='',
+                    help='directory for the runs and results (default: sweep_<config name>)')
+parser.add_argument('--workers', type=int, default=2,
+                    help='number of runs at a time')
+parser.add_argument('--threads_per_run', type=int, default=None,
+                    help='cpu threads per run (default: the cpus divided among the workers)')
+parser.add_argument('--min_epochs', type=int, default=0,
+                    help='if > 0, stop losing runs early by successive halving, \
+                    first deciding after this many epochs')
+parser.add_argument('--eta', type=int, default=2,
+                    help='successive halving keeps the best 1/eta of the runs at \
+                    each decision, and the epochs between decisions grow eta times')
+parser.add_argument('--dry_run', action='store_true',
+                    help='only print the commands')
+
+PTB_LM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ptb-lm.py')
+
+
+def load_runs(path):
+    """ Returns the flag settings (dicts) of every run in the config file. """
+    with open(path) as f:
+        config = json.load(f)
+    base = config.get('base', {})
+    runs = [dict(base, **run) for run in config.get('runs', [])]
+    grid = config.get('grid', {})
+    if grid or not runs:
+        names = sorted(grid)
+        for values in itertools.product(*[grid[name] for name in names]):
+            runs.append(dict(base, **dict(zip(names, values))))
+    return runs
+
+
+def command(flags):
+    """ The ptb-lm.py command line for flags. """
+    cmd = [sys.executable, PTB_LM]
+    for name, value in sorted(flags.items()):
+        if value is True:
+            cmd.append('--' + name)
+        elif value is not False:
+            cmd.append('--%s=%s' % (name, value))
+    return cmd
+
+
+class SuccessiveHalving:
+    """
+    Asynchronous successive halving: decides, each time a run reports the val
+    ppl of an epoch, whether it goes on. The decisions are made at the rungs,
+    epochs min_epochs * eta**k (counting from 1).
+    """
+    def __init__(self, min_epochs, eta):
+        self.min_epochs = min_epochs
+        self.eta = eta
+        self.rungs = {}  # epoch -> the val ppls reported there
+        self.lock = threading.Lock()
+
+    def is_rung(self, epoch):
+        if self.min_epochs <= 0 or epoch < self.min_epochs or epoch % self.min_epochs:
+            return False
+        k = epoch // self.min_epochs
+        while k % self.eta == 0:
+            k //= self.eta
+        return k == 1
+
+    def report(self, epoch, val_ppl):
+        """ Returns False if the run should be stopped after epoch (counting from 1). """
+        if not self.is_rung(epoch):
+            return True
+        with self.lock:
+            rung = self.rungs.setdefault(epoch, [])
+            rung.append(val_ppl)
+            kept = max(1, len(rung) // self.eta)
+            return sorted(rung).index(val_ppl) < kept
+
+
+def parse_epoch(line):
+    """ (epoch, train ppl, val ppl) from a line of ptb-lm.py's log, else None. """
+    if not line.startswith('epoch: '):
+        return None
+    fields = dict(field.split(': ', 1) for field in line.rstrip('\n').split('\t') if ': ' in field)
+    if not {'epoch', 'train ppl', 'val ppl'} <= fields.keys():
+        return None
+    return int(fields['epoch']), float(fields['train ppl']), float(fields['val ppl'])
+
+
+def run(index, flags, args, halving):
+    """ Runs one ptb-lm.py to completion (or until halving stops it); returns its results. """
+    run_dir = os.path.join(args.sweep_dir, 'run%03d' % index)
+    os.makedirs(run_dir, exist_ok=True)
+    env = dict(os.environ, OMP_NUM_THREADS=str(args.threads_per_run),
+               MKL_NUM_THREADS=str(args.threads_per_run), PYTHONUNBUFFERED='1')
+    result = dict(run=index, status='done', epochs=0, best_val_ppl=float('inf'),
+                  train_ppl=float('nan'), val_ppl=float('nan'), experiment_dir='')
+    with open(os.path.join(run_dir, 'out.txt'), 'w') as out:
+        # (run from run_dir, so that the experiment dir is made in there)
+        process = subprocess.Popen(command(flags), cwd=run_dir, env=env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1)
+        for line in process.stdout:
+            out.write(line)
+            if line.startswith('Putting log in '):
+                result['experiment_dir'] = os.path.join(run_dir, line[len('Putting log in '):].strip())
+            parsed = parse_epoch(line)
+            if parsed is None:
+                continue
+            epoch, result['train_ppl'], result['val_ppl'] = parsed
+            result['epochs'] = epoch + 1
+            result['best_val_ppl'] = min(result['best_val_ppl'], result['val_ppl'])
+            if not halving.report(epoch + 1, result['val_ppl']):
+                result['status'] = 'stopped'
+                process.terminate()
+                break
+        process.stdout.close()
+        if process.wait() != 0 and result['status'] != 'stopped':
+            result['status'] = 'failed (exit code %d, see %s)' % (
+                process.returncode, os.path.join(run_dir, 'out.txt'))
+    print('run %3d %-7s after %2d epochs, best val ppl %8.2f' % (
+        index, result['status'].split()[0], result['epochs'], result['best_val_ppl']))
+    return result
+
+
+def write_results(path, runs, results):
+    """
+    Writes the results table (best val ppl first) to path, and prints it 
+    without the experiment dirs. Of the flags, only the ones that differ 
+    between runs get a column.
+    """
+    flag_names = sorted(set(name for flags in runs for name in flags
+                            if len(set(str(f.get(name)) for f in runs)) > 1))
+    columns = ['run', 'status', 'epochs', 'best_val_ppl', 'val_ppl', 'train_ppl'] + flag_names
+    def cell(value):
+        return '%.2f' % value if isinstance(value, float) else str(value)
+    rows = [[cell(dict(runs[r['run']], **r).get(c, '')) for c in columns + ['experiment_dir']]
+            for r in sorted(results, key=lambda r: r['best_val_ppl'])]
+    with open(path, 'w') as f:
+        for row in [columns + ['experiment_dir']] + rows:
+            f.write('\t'.join(row) + '\n')
+    widths = [max([len(c)] + [len(row[i]) for row in rows]) for i, c in enumerate(columns)]
+    for row in [columns] + rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    runs = load_runs(args.config)
+    if not args.sweep_dir:
+        args.sweep_dir = 'sweep_' + os.path.splitext(os.path.basename(args.config))[0]
+    if args.threads_per_run is None:
+        args.threads_per_run = max(1, (os.cpu_count() or 1) // args.workers)
+    print('%d runs, %d at a time with %d threads each, in %s' % (
+        len(runs), args.workers, args.threads_per_run, args.sweep_dir))
+
+    # The runs are started from their own directories, so the data path is
+    # made absolute, and the data is tokenized (and cached) once, here.
+    for flags in runs:
+        flags['data'] = os.path.abspath(flags.get('data', 'data'))
+    if args.dry_run:
+        for flags in runs:
+            print(' '.join(command(flags)))
+        sys.exit(0)
+    for data_path in sorted(set(flags['data'] for flags in runs)):
+        ptb_raw_data(data_path=data_path)
+
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    with open(os.path.join(args.sweep_dir, 'runs.json'), 'w') as f:
+        json.dump(runs, f, indent=1)
+    halving = SuccessiveHalving(args.min_epochs, args.eta)
+    with ThreadPoolExecutor(args.workers) as pool:
+        results = list(pool.map(lambda i: run(i, runs[i], args, halving), range(len(runs))))
+
+    print()
+    write_results(os.path.join(args.sweep_dir, 'results.tsv'), runs, results)